@@ -0,0 +1,193 @@
+import os
+import json
+import shutil
+import importlib.util
+import multiprocessing
+from pathlib import Path
+import cv2
+from image_store import ImageStore
+
+
+def load_stage(filename):
+    """
+    Imports one of the numbered stage scripts as a module. Their file names are
+    not valid module names, so they cannot be imported the usual way; their main
+    blocks only run when they are executed directly.
+    """
+    path = Path(__file__).parent / filename
+    spec = importlib.util.spec_from_file_location(path.stem.replace('.', '_').replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+stage_generate = load_stage('0_generate_random_data.py')
+stage_crop = load_stage('1_crop_images_vertically.py')
+stage_augment = load_stage('2_augment_images.py')
+stage_coco = load_stage('3.1_convert_to_coco.py')
+stage_yolo = load_stage('4.1_convert_to_yolo.py')
+
+
+# ------------------ Stages ------------------
+# Each stage is a generator over (doc_type, stem, image, widgets) samples, where
+# stem is the file name the stand-alone scripts would give the sample.
+
+def generate(units):
+    for unit in units:
+        pdf_path, page_num, sample_no = unit
+        image, widgets, _ = stage_generate.render_sample(unit)
+        yield pdf_path.name, f'{page_num+1}_{sample_no}', image, widgets
+
+def crop(samples, crop_height):
+    for doc_type, stem, image, widgets in samples:
+        crops = stage_crop.crop_sample(image, widgets, crop_height)
+        for i, (cropped, cropped_widgets) in enumerate(crops):
+            yield doc_type, f'{stem}_crop_{i}', cropped, cropped_widgets
+
+def augment(samples):
+    for doc_type, stem, image, widgets in samples:
+        try:
+            aug_image, aug_widgets = stage_augment.augment_sample(image, widgets)
+        except Exception as e:
+            # same as 2_augment_images.py: a failed augmentation drops the sample
+            print(e)
+            continue
+        yield doc_type, stem, aug_image, aug_widgets
+
+def tap(samples, tap_dir):
+    """
+    Debug tap: writes every sample passing through to 'tap_dir' in the layout the
+    stand-alone script of that stage would use (<doc_type>/image, <doc_type>/json).
+    """
+    for doc_type, stem, image, widgets in samples:
+        if tap_dir is not None:
+            os.makedirs(tap_dir / doc_type / 'image', exist_ok=True)
+            os.makedirs(tap_dir / doc_type / 'json', exist_ok=True)
+            cv2.imwrite(str(tap_dir / doc_type / 'image' / f'{stem}.jpg'), image)
+            with open(tap_dir / doc_type / 'json' / f'{stem}.json', 'w') as f:
+                json.dump(widgets, f, indent=4)
+        yield doc_type, stem, image, widgets
+
+
+def process_unit(unit):
+    """
+    Runs one (pdf, page, sample) unit through generate -> crop -> augment and
+    returns its final samples as (doc_type, stem, jpeg_bytes, width, height, widgets),
+    so the only JPEG encoding is the one of the exported image.
+    """
+    pdf_path, page_num, sample_no = unit
+    # render_sample seeds 'random' for the unit; the augmentations also draw from
+    # generators of their own
+    stage_augment.seed_augmentation(
+        stage_generate.get_unit_seed(pdf_path.name, page_num, sample_no, stage_generate.GLOBAL_SEED))
+
+    samples = tap(generate([unit]), TAP_GENERATED_DIR)
+    samples = tap(crop(samples, CROP_HEIGHT), TAP_CROPPED_DIR)
+    samples = tap(augment(samples), TAP_AUGMENTED_DIR)
+
+    results = []
+    for doc_type, stem, image, widgets in samples:
+        ok, encoded = cv2.imencode('.jpg', image)
+        if not ok:
+            print(f"Could not encode {doc_type}/{stem}")
+            continue
+        height, width = image.shape[:2]
+        results.append((doc_type, stem, encoded.tobytes(), width, height, widgets))
+    return results
+
+
+def write_image(encoded, path, image_store=None):
+    if image_store is not None:
+        image_store.export_bytes(encoded, path)
+        return
+    with open(path, 'wb') as f:
+        f.write(encoded)
+
+
+# ------------------ Configuration ------------------
+CROP_HEIGHT = stage_crop.CROP_HEIGHT
+
+EXPORT_COCO = True
+EXPORT_YOLO = True
+coco_dir = Path(stage_coco.output_dir)
+yolo_dir = Path(stage_yolo.output_dir)
+# both exports link their images to one store file (see image_store.py); None writes them twice
+IMAGE_STORE_DIR = stage_coco.IMAGE_STORE_DIR
+
+# Debug taps: set to a directory (e.g. Path('out_1_cropped_images')) to also dump
+# what that stage produces; None keeps everything in memory
+TAP_GENERATED_DIR = None
+TAP_CROPPED_DIR = None
+TAP_AUGMENTED_DIR = None
+
+# the synthetic sample PDFs are a by-product of stage 0 only
+stage_generate.SAVE_PDFS = False
+
+NUM_WORKERS = stage_generate.NUM_WORKERS
+
+
+if __name__ == '__main__':
+    for tap_dir in (TAP_GENERATED_DIR, TAP_CROPPED_DIR, TAP_AUGMENTED_DIR):
+        if tap_dir is not None:
+            shutil.rmtree(tap_dir, ignore_errors=True)
+    if EXPORT_COCO:
+        shutil.rmtree(coco_dir, ignore_errors=True)
+        os.makedirs(coco_dir / 'images')
+    if EXPORT_YOLO:
+        shutil.rmtree(yolo_dir, ignore_errors=True)
+        os.makedirs(yolo_dir / 'images')
+        os.makedirs(yolo_dir / 'labels')
+
+    if stage_generate.USE_FAKE_VALUE_BANK:
+        stage_generate.ensure_fake_value_bank(stage_generate.FAKE_VALUE_BANK_PATH,
+                                              stage_generate.FAKE_VALUES_PER_TYPE,
+                                              stage_generate.GLOBAL_SEED)
+
+    units, _ = stage_generate.get_work_units(stage_generate.pdf_paths)
+
+    # ordered imap, so COCO ids do not depend on the worker count; fork, since
+    # the stage modules loaded above can not be imported by name in a fresh process
+    # chunks of one page's samples, so each page background is rendered once
+    pool = multiprocessing.get_context('fork').Pool(NUM_WORKERS) if NUM_WORKERS > 1 else None
+    if pool:
+        results = pool.imap(process_unit, units, chunksize=stage_generate.SAMPLES_PER_PAGE)
+    else:
+        results = map(process_unit, units)
+
+    image_store = ImageStore(IMAGE_STORE_DIR) if IMAGE_STORE_DIR else None
+    coco_images, coco_annotations = [], []
+    annotation_id = 1
+    for idx, unit_samples in enumerate(results):
+        print(f'{idx+1}/{len(units)} {units[idx][0].name}')
+        for doc_type, stem, encoded, width, height, widgets in unit_samples:
+            prefixed_name = f"{doc_type}_{stem}"
+
+            if EXPORT_COCO:
+                image_id = len(coco_images) + 1
+                coco_images.append({
+                    "id": image_id,
+                    "file_name": f"{prefixed_name}.jpg",
+                    "width": width,
+                    "height": height
+                })
+                image_annotations = stage_coco.get_coco_annotations(widgets, image_id, annotation_id)
+                coco_annotations.extend(image_annotations)
+                annotation_id += len(image_annotations)
+                write_image(encoded, coco_dir / 'images' / f"{prefixed_name}.jpg", image_store)
+
+            if EXPORT_YOLO:
+                with open(yolo_dir / 'labels' / f"{prefixed_name}.txt", 'w') as f:
+                    f.writelines(stage_yolo.get_yolo_lines(widgets, width, height))
+                write_image(encoded, yolo_dir / 'images' / f"{prefixed_name}.jpg", image_store)
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    if EXPORT_COCO:
+        stage_coco.write_coco_annotations(coco_images, coco_annotations, str(coco_dir))
+    if image_store is not None:
+        image_store.prune()
+        print(image_store.summary())
+
+    print('Done...!')
@@ -3,13 +3,25 @@ import cv2
 import numpy as np
 import os
 import shutil
+import hashlib
+import inspect
+import importlib.util
+import functools
+import math
+import multiprocessing
 import unicodedata
 from pathlib import Path
-import tempfile
 import json
 import random
 import string
-from faker import Faker
+from collections import OrderedDict, namedtuple
+from faker import Faker, VERSION as FAKER_VERSION
+
+from fake_value_bank import FakeValueBank, read_fake_value_bank_params, write_fake_value_bank
+from stage_manifest import get_file_digest, open_manifest
+from sample_shards import ShardWriter, encode_image
+from raw_raster import RasterWriter
+from image_meta import with_image_size
 
 
 def do_bboxes_overlap(bbox1: dict, bbox2: dict) -> bool:
@@ -19,17 +31,133 @@ def do_bboxes_overlap(bbox1: dict, bbox2: dict) -> bool:
     return True
 
 
-def get_page_raster(page: fitz.Page, target_width: int, target_height: int) -> np.ndarray:
+class OccupancyGrid:
+    """
+    Occupancy of a page on a 1pt grid. For each box size asked for, the top-left
+    positions where a box of that size fits without touching an occupied cell are
+    kept as a boolean mask (built once from a summed-area table, then updated on
+    every add), so a free position is drawn in one go.
+    """
+
+    def __init__(self, width: int, height: int):
+        self.width, self.height = width, height
+        self.grid = np.zeros((height, width), dtype=bool)
+        self._free_masks = {}
+
+    def add(self, bbox: dict) -> None:
+        c0, r0 = max(0, math.floor(bbox['xmin'])), max(0, math.floor(bbox['ymin']))
+        c1, r1 = min(self.width, math.ceil(bbox['xmax'])), min(self.height, math.ceil(bbox['ymax']))
+        if c1 <= c0 or r1 <= r0:
+            return
+        self.grid[r0:r1, c0:c1] = True
+        for (kh, kw), mask in self._free_masks.items():
+            mask[max(0, r0 - kh + 1):r1, max(0, c0 - kw + 1):c1] = False
+
+    def _free_mask(self, width: float, height: float) -> np.ndarray:
+        kw, kh = max(1, math.ceil(width)), max(1, math.ceil(height))
+        if (kh, kw) not in self._free_masks:
+            # positions keep the box strictly inside the page
+            nx = max(0, min(self.width - kw + 1, math.ceil(self.width - width)))
+            ny = max(0, min(self.height - kh + 1, math.ceil(self.height - height)))
+            sat = np.zeros((self.height + 1, self.width + 1), dtype=np.int32)
+            np.cumsum(np.cumsum(self.grid, axis=0, dtype=np.int32), axis=1, out=sat[1:, 1:])
+            window = (sat[kh:kh + ny, kw:kw + nx] - sat[:ny, kw:kw + nx]
+                      - sat[kh:kh + ny, :nx] + sat[:ny, :nx])
+            self._free_masks[(kh, kw)] = window == 0
+        return self._free_masks[(kh, kw)]
+
+    def sample_free_position(self, width: float, height: float) -> tuple[int, int] | None:
+        mask = self._free_mask(width, height)
+        free = np.flatnonzero(mask)
+        if free.size == 0:
+            return None
+        ymin, xmin = divmod(int(free[random.randrange(free.size)]), mask.shape[1])
+        return xmin, ymin
+
+
+class PixmapBuffer:
+    # a fitz.Pixmap's samples for numpy; arrays made from it have it as their
+    # .base, so the pixmap stays alive for as long as any of them does, and they
+    # are plain ndarrays (pickled with a copy of the pixels, like any other)
+    def __init__(self, pix: fitz.Pixmap):
+        self.pixmap = pix
+        self.__array_interface__ = {
+            'shape': (pix.height, pix.width, pix.n),
+            'typestr': '|u1',
+            'data': (pix.samples_ptr, False),
+            'version': 3,
+        }
+
+
+def get_pixmap_array(pix: fitz.Pixmap) -> np.ndarray:
+    return np.asarray(PixmapBuffer(pix))
+
+
+def get_page_raster(page: fitz.Page, target_width: int, target_height: int, bgr: bool = True,
+                    background: np.ndarray | None = None) -> np.ndarray:
+    # with a background (a raster of the same size and channel order), the page is
+    # rendered with transparency and composited onto it
     scale_w = target_width / page.rect.width
     scale_h = target_height / page.rect.height
     matrix = fitz.Matrix(scale_w, scale_h)
-    pix = page.get_pixmap(matrix=matrix)
-    with tempfile.NamedTemporaryFile(delete=True, suffix='.jpg') as temp_file: 
-        pix.save(temp_file.name)
-        img = cv2.imread(temp_file.name)
+    pix = page.get_pixmap(matrix=matrix, alpha=background is not None)
+
+    # wrap the pixmap samples without copying; the only pass over the pixels is the
+    # in-place RGB->BGR swap, so the image is encoded once, at the final write
+    img = get_pixmap_array(pix)
+    if background is not None:
+        return composite_overlay(background, img, bgr)
+    if bgr:
+        cv2.cvtColor(img, cv2.COLOR_RGB2BGR, dst=img)
     return img
 
 
+def get_page_tiles(page: fitz.Page, target_width: int, target_height: int, offsets: list[int],
+                   tile_height: int, bgr: bool = True, background: np.ndarray | None = None) -> list[np.ndarray]:
+    # rows [offset, offset + tile_height) of what get_page_raster would return, each
+    # rendered on its own through a clip rectangle, so the whole page never is
+    scale_w = target_width / page.rect.width
+    scale_h = target_height / page.rect.height
+    matrix = fitz.Matrix(scale_w, scale_h)
+
+    tiles = []
+    for offset in offsets:
+        bottom = min(offset + tile_height, target_height)
+        clip = fitz.Rect(0, offset / scale_h, page.rect.width, bottom / scale_h)
+        pix = page.get_pixmap(matrix=matrix, clip=clip, alpha=background is not None)
+        assert (pix.width, pix.height) == (target_width, bottom - offset), (pix.width, pix.height)
+
+        tile = get_pixmap_array(pix)
+        if background is not None:
+            tile = composite_overlay(background[offset:bottom], tile, bgr)
+        elif bgr:
+            cv2.cvtColor(tile, cv2.COLOR_RGB2BGR, dst=tile)
+        tiles.append(tile)
+    return tiles
+
+
+def composite_overlay(background: np.ndarray, overlay: np.ndarray, bgr: bool = True) -> np.ndarray:
+    # overlay is an RGBA raster; MuPDF's alpha pixmaps are premultiplied, so 'over'
+    # is overlay + background * (1 - alpha). cv2 keeps this to a few SIMD passes
+    inv_alpha = cv2.bitwise_not(cv2.extractChannel(overlay, 3))
+    color = cv2.cvtColor(overlay, cv2.COLOR_RGBA2BGR if bgr else cv2.COLOR_RGBA2RGB)
+    out = cv2.multiply(background, cv2.merge([inv_alpha] * 3), scale=1/255)
+    return cv2.add(out, color, dst=out)
+
+
+@functools.lru_cache(maxsize=8)
+def get_page_background(pdf_path: Path, page_num: int, target_width: int, target_height: int) -> np.ndarray:
+    # the template page as every sample leaves it: checkbox widgets are always
+    # deleted, everything else stays; cached for the few pages a worker is on
+    doc = open_template(pdf_path)
+    page = doc.load_page(page_num)
+    delete_checkbox_widgets(page)
+    background = get_page_raster(page, target_width, target_height)
+    background.flags.writeable = False
+    doc.close()
+    return background
+
+
 def scale_bbox(bbox: dict, scale_w: float, scale_h: float) -> dict:
     scaled_bbox = {}
     scaled_bbox['xmin'] = bbox['xmin']*scale_w
@@ -65,16 +193,19 @@ def render_textfield_annotations(page: fitz.Page) -> fitz.Page:
     return page     
 
 
-def get_page_widgets(page: fitz.Page, target_width: int, target_height: int) -> list:
+def get_page_widgets(page: fitz.Page, target_width: int, target_height: int,
+                     widgets: list | None = None) -> list:
     scale_w = target_width / page.rect.width
     scale_h = target_height / page.rect.height
 
     widgets_list = []
+    if widgets is None:
+        widgets = extract_page_widgets(page)
     
-    for widget in page.widgets():
-        field_name = widget.field_name
+    for widget in widgets:
+        field_name = widget.name
         field_type = widget.field_type # 2 for checkbox, 7 for text_area
-        text =  widget.field_value
+        text =  widget.value
         xmin, ymin, xmax, ymax = widget.rect        
         xmin_scaled, ymin_scaled, xmax_scaled, ymax_scaled = xmin*scale_w, ymin*scale_h,\
                                     xmax*scale_w, ymax*scale_h
@@ -104,6 +235,89 @@ def get_page_widgets(page: fitz.Page, target_width: int, target_height: int) ->
     return widgets_list
             
 
+TemplateWidget = namedtuple('TemplateWidget', ['name', 'field_type', 'type_string', 'value', 'rect', 'xref'])
+
+
+def extract_page_widgets(page: fitz.Page) -> list[TemplateWidget]:
+    return [TemplateWidget(widget.field_name, widget.field_type, widget.field_type_string,
+                           widget.field_value, tuple(widget.rect), widget.xref)
+            for widget in page.widgets()]
+
+
+def build_widget_index(pdf_path: Path, index_path: Path, file_digest: str) -> None:
+    pages, widgets = [], []
+    with fitz.open(str(pdf_path)) as doc:
+        page_count = len(doc)
+        for page in doc:
+            page_widgets = extract_page_widgets(page)
+            pages += [page.number] * len(page_widgets)
+            widgets += page_widgets
+
+    os.makedirs(index_path.parent, exist_ok=True)
+    np.savez(index_path,
+             sha256=np.array(file_digest),
+             page_count=np.array(page_count),
+             page=np.array(pages, dtype=np.int32),
+             name=np.array([w.name for w in widgets], dtype=str),
+             field_type=np.array([w.field_type for w in widgets], dtype=np.int8),
+             type_string=np.array([w.type_string for w in widgets], dtype=str),
+             value=np.array([str(w.value) for w in widgets], dtype=str),
+             rect=np.array([w.rect for w in widgets], dtype=np.float64).reshape(-1, 4),
+             xref=np.array([w.xref for w in widgets], dtype=np.int32))
+
+
+_widget_index_cache = {}
+
+
+def get_template_widgets(pdf_path: Path) -> dict[int, list[TemplateWidget]]:
+    """
+    Widgets of every page of a template, keyed by page number. The template layout
+    never changes between samples, so it is read from an index stored in
+    widget_index_dir and only re-extracted when the PDF's hash changes.
+    """
+    if pdf_path in _widget_index_cache:
+        return _widget_index_cache[pdf_path]
+
+    file_digest = get_file_digest(pdf_path)
+    index_path = widget_index_dir / f'{pdf_path.name}.npz'
+    is_stale = True
+    if index_path.exists():
+        with np.load(index_path) as index:
+            is_stale = str(index['sha256']) != file_digest
+    if is_stale:
+        build_widget_index(pdf_path, index_path, file_digest)
+
+    with np.load(index_path) as index:
+        page_widgets = {page_num: [] for page_num in range(int(index['page_count']))}
+        for page_num, name, field_type, type_string, value, rect, xref in zip(
+                index['page'].tolist(), index['name'].tolist(), index['field_type'].tolist(),
+                index['type_string'].tolist(), index['value'].tolist(), index['rect'].tolist(),
+                index['xref'].tolist()):
+            page_widgets[page_num].append(TemplateWidget(name, field_type, type_string, value, tuple(rect), xref))
+
+    _widget_index_cache[pdf_path] = page_widgets
+    return page_widgets
+
+
+_template_bytes = OrderedDict()
+
+
+def open_template(pdf_path: Path) -> fitz.Document:
+    # a fresh document parsed from the template's bytes, which are read once per
+    # process and kept for the TEMPLATE_POOL_SIZE most recently used templates.
+    # Every sample edits and drops its own document, so nothing is reset; a single
+    # shared document would not do, as insert_pdf strips the form fields of the
+    # document it copies from
+    if pdf_path in _template_bytes:
+        _template_bytes.move_to_end(pdf_path)
+    else:
+        with open(pdf_path, 'rb') as f:
+            _template_bytes[pdf_path] = f.read()
+        while len(_template_bytes) > TEMPLATE_POOL_SIZE:
+            _template_bytes.popitem(last=False)
+    return fitz.open(stream=_template_bytes[pdf_path], filetype='pdf')
+
+
 def get_xstart_ystart(widget_type: str, text: str, xmin: int, ymin: 
                       int, xmax: int, ymax: int, font_size: int
                       ) -> tuple:
@@ -142,8 +356,113 @@ def get_xstart_ystart(widget_type: str, text: str, xmin: int, ymin:
         return x_start, y_start
 
 
+RegisteredFont = namedtuple('RegisteredFont', ['font', 'buffer', 'ascender', 'descender', 'advances'])
+
+_font_registry = {}
+
+
+def get_registered_font(fontfile: str) -> RegisteredFont:
+    # each font file is read and parsed once per process; glyph advances are
+    # filled in as characters are first measured
+    fontfile = str(fontfile)
+    if fontfile not in _font_registry:
+        with open(fontfile, 'rb') as f:
+            buffer = f.read()
+        font = fitz.Font(fontbuffer=buffer)
+        _font_registry[fontfile] = RegisteredFont(font, buffer, font.ascender, font.descender, {})
+    return _font_registry[fontfile]
+
+
+def get_font_files() -> dict[str, str]:
+    return {font_name: str(font_dir/font_name) for font_name in sorted(os.listdir(font_dir))}
+
+
+def get_text_length(fontfile: str, text: str, fontsize: float) -> float:
+    # same result as fitz.Font.text_length, from cached per-glyph advances
+    registered = get_registered_font(fontfile)
+    advances = registered.advances
+    for char in text:
+        if char not in advances:
+            advances[char] = registered.font.glyph_advance(ord(char))
+    return sum(advances[char] for char in text) * fontsize
+
+
+def insert_registered_font(page: fitz.Page, fontname: str, fontfile: str, page_fonts: set) -> None:
+    # MuPDF embeds a given font program once per document (it matches fonts by
+    # digest), so all that is left per page is the resource entry; add it only
+    # for fonts the page actually uses, from the cached buffer
+    if fontname not in page_fonts:
+        page.insert_font(fontname=fontname, fontbuffer=get_registered_font(fontfile).buffer)
+        page_fonts.add(fontname)
+
+
+_emitter_fonts = {}
+def get_emitter_font(fontname: str, fontfile: str | None = None) -> fitz.Font | None:
+    # fitz.Font for a TextWriter: base-14 fonts by name, the rest from the registry.
+    # Fonts flagged never-embed make MuPDF's PDF device fail on write_text, so
+    # None is returned for them and they are written with insert_text instead
+    key = (fontname, fontfile)
+    if key not in _emitter_fonts:
+        font = fitz.Font(fontname) if fontfile is None else get_registered_font(fontfile).font
+        _emitter_fonts[key] = None if font.flags['never-embed'] else font
+    return _emitter_fonts[key]
+
+
+class PageEmitter:
+    """
+    Collects the text and rectangles added to a page and writes them in a few
+    operations: rectangles through one Shape and the text through one
+    TextWriter per colour. Drawing order between rectangles and text is kept: a
+    rectangle added after text writes that text first (copy-paste checkboxes
+    whiten their surroundings, which must not cover what was drawn before).
+    Anything drawn on the page directly, such as an image, needs a flush()
+    before it for the same reason.
+    """
+
+    def __init__(self, page: fitz.Page):
+        self.page = page
+        self.page_fonts = set()
+        self.shape = None
+        self.writers = {}
+        self.direct_text = []
+        # TextWriter does not derotate positions the way insert_text does
+        self.batch_text = page.rotation == 0
+
+    def rect(self, rect: fitz.Rect, color: tuple | None = None, fill: tuple | None = None,
+             width: float = 1) -> None:
+        if self.writers or self.direct_text:
+            self.flush()
+        if self.shape is None:
+            self.shape = self.page.new_shape()
+        self.shape.draw_rect(rect)
+        self.shape.finish(color=color, fill=fill, width=width)
+
+    def text(self, point: tuple, text: str, fontname: str, fontsize: float,
+             color: tuple = (0, 0, 0), fontfile: str | None = None) -> None:
+        font = get_emitter_font(fontname, fontfile) if self.batch_text else None
+        if font is None:
+            self.direct_text.append((point, text, fontname, fontsize, color, fontfile))
+            return
+        if color not in self.writers:
+            self.writers[color] = fitz.TextWriter(self.page.rect, color=color)
+        self.writers[color].append(point, text, font=font, fontsize=fontsize)
+
+    def flush(self) -> None:
+        if self.shape is not None:
+            self.shape.commit()
+            self.shape = None
+        for writer in self.writers.values():
+            writer.write_text(self.page)
+        self.writers = {}
+        for point, text, fontname, fontsize, color, fontfile in self.direct_text:
+            if fontfile is not None:
+                insert_registered_font(self.page, fontname, fontfile, self.page_fonts)
+            self.page.insert_text(point, text, fontname=fontname, fontsize=fontsize, color=color)
+        self.direct_text = []
+
+
 def get_fontsize_for_target_height(fontfile: str, target_height_px: float) -> float:
-    font = fitz.Font(fontfile=fontfile)
+    font = get_registered_font(fontfile)
     ascender = font.ascender
     descender = abs(font.descender)
     total_font_units = ascender + descender
@@ -152,7 +471,7 @@ def get_fontsize_for_target_height(fontfile: str, target_height_px: float) -> fl
 
 
 def get_font_baseline_y(fontfile: str, fontsize: float, ymin: float, ymax: float) -> float:
-    font = fitz.Font(fontfile=fontfile)
+    font = get_registered_font(fontfile)
     
     ascent = font.ascender / 1000 * fontsize
     descent = abs(font.descender) / 1000 * fontsize
@@ -163,32 +482,66 @@ def get_font_baseline_y(fontfile: str, fontsize: float, ymin: float, ymax: float
     return baseline_y
 
 
-def add_signatures_to_textfields(page, sign_enclosure_dir):
-    font_names = os.listdir('TEMPLATE_PDF/fonts')
-    font_dict = {i: f'TEMPLATE_PDF/fonts/{i}' for i in font_names}
+SignatureAsset = namedtuple('SignatureAsset', ['name', 'data', 'width', 'height', 'aspect_ratio'])
+
+_signature_assets = {}
+
+
+def get_signature_assets(sign_enclosure_dir: Path) -> list[SignatureAsset]:
+    # read and measured once per process instead of once per placed signature
+    if sign_enclosure_dir in _signature_assets:
+        return _signature_assets[sign_enclosure_dir]
 
-    for font_name in font_dict:
-        page.insert_font(fontfile=font_dict[font_name], fontname=font_name)   
+    assets = []
+    for sign_filename in sorted(os.listdir(sign_enclosure_dir)):
+        with open(str(sign_enclosure_dir/sign_filename), "rb") as img_file:
+            signature_bytes = img_file.read()
+        try:
+            pix = fitz.Pixmap(signature_bytes)
+        except Exception as e:
+            print(f"Error reading image dimensions of {sign_filename}: {e}")
+            continue
+        assets.append(SignatureAsset(sign_filename, signature_bytes, pix.width, pix.height,
+                                     pix.width / pix.height))
+
+    _signature_assets[sign_enclosure_dir] = assets
+    return assets
+
+
+def insert_signature_image(page: fitz.Page, rect: fitz.Rect, sign: SignatureAsset, image_xrefs: dict) -> None:
+    # the first placement embeds the image, later ones in the same document point at that xref
+    if sign.name in image_xrefs:
+        page.insert_image(rect, xref=image_xrefs[sign.name])
+    else:
+        image_xrefs[sign.name] = page.insert_image(rect, stream=sign.data)
+
+
+def add_signatures_to_textfields(page, sign_enclosure_dir, widgets=None, image_xrefs=None, emitter=None):
+    font_dict = get_font_files()
     
-    sign_enclosure_files = os.listdir(sign_enclosure_dir) 
+    sign_assets = get_signature_assets(sign_enclosure_dir)
     
-    if not sign_enclosure_files:
+    if not sign_assets:
         print(f"No signature files found in {sign_enclosure_dir}")
         return page, {}
+
+    # image xrefs already embedded in page.parent, keyed by signature file name
+    if image_xrefs is None:
+        image_xrefs = {}
     
     gt = {}
     sign_count = 0
 
-    locales = [
-        'en_US', 'en_GB', 'en_CA', 'en_AU', 'en_NZ', 'en_IE',  # English-speaking
-        'en_IN',# 'ja_JP', 'ko_KR', 'zh_CN', 'zh_TW',  # Asian
-        'fr_FR', 'de_DE', 'it_IT', 'nl_NL', 'pt_PT',  # European
-        'es_MX', 'es_ES', 'es_CO', 'es_AR', 'es_CL'  # Spanish-speaking (Latin America and Europe)
-    ]
+    if widgets is None:
+        widgets = extract_page_widgets(page)
 
-    for widget in page.widgets():
-        widget_name = widget.field_name
-        widget_type = widget.field_type_string
+    flush_emitter = emitter is None
+    if flush_emitter:
+        emitter = PageEmitter(page)
+
+    for widget in widgets:
+        widget_name = widget.name
+        widget_type = widget.type_string
         
         if widget_type!='Text':
             continue
@@ -199,30 +552,9 @@ def add_signatures_to_textfields(page, sign_enclosure_dir):
         xmin, ymin, xmax, ymax = widget.rect
         widget_w, widget_h = xmax - xmin, ymax - ymin
         
-        sign_filename = random.choice(sign_enclosure_files)
-        sign_path = sign_enclosure_dir/sign_filename
-        with open(str(sign_path), "rb") as img_file:
-            signature_bytes = img_file.read()
-        
-        img_rect = fitz.Rect(0, 0, 0, 0)
-        try:
-            img_doc = fitz.open(stream=signature_bytes, filetype="png")
-            if img_doc.page_count > 0:
-                img_page = img_doc[0]
-                img_rect = img_page.rect
-                img_doc.close()
-        except:
-            try:
-                img_doc = fitz.open(stream=signature_bytes, filetype="jpeg")
-                if img_doc.page_count > 0:
-                    img_page = img_doc[0]
-                    img_rect = img_page.rect
-                    img_doc.close()
-            except Exception as e:
-                print(f"Error reading image dimensions: {e}")
-                continue
-                 
-        sign_aspect_ratio = img_rect.width / img_rect.height
+        sign = random.choice(sign_assets)
+        sign_filename = sign.name
+        sign_aspect_ratio = sign.aspect_ratio
         target_height = int(widget_h * random.uniform(1.3, 2.5))
         target_width = int(target_height * sign_aspect_ratio)
         
@@ -251,7 +583,9 @@ def add_signatures_to_textfields(page, sign_enclosure_dir):
         if 'real' not in sign_filename:
             # print(sign_filename, img_xmin, img_ymin, img_xmax, img_ymax)
             rect = fitz.Rect(img_xmin, img_ymin, img_xmax, img_ymax)
-            page.insert_image(rect, stream=signature_bytes)
+            # the names of the signatures before go under this one, as they were drawn first
+            emitter.flush()
+            insert_signature_image(page, rect, sign, image_xrefs)
             if img_xmin>=img_xmax or img_ymin>=img_ymax:
                 continue
         
@@ -260,17 +594,18 @@ def add_signatures_to_textfields(page, sign_enclosure_dir):
             r,g,b = random.randint(1, 200), random.randint(1, 200), random.randint(1, 200)
         r,g,b = r/256, g/256, b/256
         
-        locale = random.choice(locales)
-        localized_fake = Faker(locale)
-        first_name = localized_fake.first_name()
+        if USE_FAKE_VALUE_BANK:
+            first_name = get_fake_value_bank().choice('first_name')
+        else:
+            locale = random.choice(FAKER_LOCALES)
+            first_name = get_faker(locale).first_name()
         
         font_name = random.choice(list(font_dict.keys()))
         font_path = font_dict[font_name]
-        font = fitz.Font(fontfile=font_path)
         
         text_height = (img_ymax-img_ymin)*random.uniform(0.8, 1.2)
         font_size = get_fontsize_for_target_height(font_path, text_height)
-        text_width = font.text_length(first_name, fontsize=font_size)
+        text_width = get_text_length(font_path, first_name, font_size)
         
         text_xmin = img_xmin + random.randint(1, 10)
         text_xmax = text_xmin + text_width
@@ -281,7 +616,7 @@ def add_signatures_to_textfields(page, sign_enclosure_dir):
         if 'real' in sign_filename:
             text_height = (ymax-ymin)*random.uniform(1.5, 2)
             font_size = get_fontsize_for_target_height(font_path, text_height)
-            text_width = font.text_length(first_name, fontsize=font_size)
+            text_width = get_text_length(font_path, first_name, font_size)
             
             text_xmin = xmin + random.randint(5, 10)
             text_xmax = text_xmin + text_width
@@ -298,16 +633,18 @@ def add_signatures_to_textfields(page, sign_enclosure_dir):
             img_xmax = img_xmin + img_width
             
             rect = fitz.Rect(img_xmin, img_ymin, img_xmax, img_ymax)
-            page.insert_image(rect, stream=signature_bytes)
+            emitter.flush()
+            insert_signature_image(page, rect, sign, image_xrefs)
             
         text_y_baseline = text_ymax - 2
         
-        page.insert_text(
+        emitter.text(
             (text_xmin, text_y_baseline),
             first_name,
             fontname=font_name,
             fontsize = font_size,
-            color=(r, g, b)
+            color=(r, g, b),
+            fontfile=font_path
         )
 
         tmp_dict =  {
@@ -323,18 +660,34 @@ def add_signatures_to_textfields(page, sign_enclosure_dir):
         gt[f"<SIGN_{sign_count}>"] = tmp_dict
         sign_count += 1
     
+    if flush_emitter:
+        emitter.flush()
     return page, gt
 
     
-def add_random_checkboxes(page: fitz.Page, copy_paste: bool = True) -> tuple[fitz.Page, dict]:
+def delete_checkbox_widgets(page: fitz.Page) -> None:
+    for widget in list(page.widgets(types=[fitz.PDF_WIDGET_TYPE_CHECKBOX])):
+        page.delete_widget(widget)
+
+
+def add_random_checkboxes(page: fitz.Page, copy_paste: bool = True, widgets: list | None = None,
+                          emitter: PageEmitter | None = None,
+                          delete_widgets: bool = True) -> tuple[fitz.Page, dict]:
     font = 'DVS'
-    page.insert_font(fontfile='TEMPLATE_PDF/fonts/DejaVuSans.ttf', fontname=font)
+    fontfile = str(font_dir/'DejaVuSans.ttf')
     page_w, page_h = int(page.rect.width), int(page.rect.height)
     gt = {}
 
-    for widget in page.widgets():
-        widget_name = widget.field_name
-        widget_type = widget.field_type_string
+    if widgets is None:
+        widgets = extract_page_widgets(page)
+
+    flush_emitter = emitter is None
+    if flush_emitter:
+        emitter = PageEmitter(page)
+
+    for widget in widgets:
+        widget_name = widget.name
+        widget_type = widget.type_string
 
         if widget_type != 'CheckBox':
             continue
@@ -343,7 +696,8 @@ def add_random_checkboxes(page: fitz.Page, copy_paste: bool = True) -> tuple[fit
         width = xmax - xmin
         height = ymax - ymin
         font_size = int(min(width, height) * random.uniform(0.9, 1.6))
-        page.delete_widget(widget)
+        if delete_widgets:
+            page.delete_widget(page.load_widget(widget.xref))
 
         # keep 40% cboxes empty
         if random.random() <= 0.4:
@@ -359,7 +713,7 @@ def add_random_checkboxes(page: fitz.Page, copy_paste: bool = True) -> tuple[fit
             r,g,b = random.randint(1, 200), random.randint(1, 200), random.randint(1, 200)
         r, g, b = r/256, g/256, b/256 
         symbol = random.choice(["●", "◉", "✖", "X", "✔", "✓"])
-        page.insert_text((xmin + 1, ymax - 2), symbol, fontsize=font_size, fontname=font, color=(0, 0, 0))
+        emitter.text((xmin + 1, ymax - 2), symbol, fontsize=font_size, fontname=font, color=(0, 0, 0), fontfile=fontfile)
 
         gt[widget_name] = {
             "widget_type": "checkbox",
@@ -369,6 +723,10 @@ def add_random_checkboxes(page: fitz.Page, copy_paste: bool = True) -> tuple[fit
 
     # Copy-paste augmentation
     if copy_paste and len(gt)>0:
+        occupancy = OccupancyGrid(page_w, page_h)
+        for gt_cbox in gt.values():
+            occupancy.add(gt_cbox['bbox'])
+
         for copied_idx in range(random.randint(1, max(len(gt), 10))):
             src_key = random.choice(list(gt.keys()))
             src_cbox = gt[src_key]
@@ -377,31 +735,20 @@ def add_random_checkboxes(page: fitz.Page, copy_paste: bool = True) -> tuple[fit
             height = bbox['ymax'] - bbox['ymin']
             font_size = int(min(width, height) * random.uniform(0.9, 1.6))
             
-            for _ in range(20):
-                xmin = random.randint(0, page_w)
-                ymin = random.randint(0, page_h)
-                xmax = xmin + width
-                ymax = ymin + height
-                
-                if xmax>=page_w or ymax>=page_h:
-                    continue
-                
-                does_overlap = False
-                for key, gt_cbox in gt.items():
-                    copied_bbox = {'xmin': xmin, 'ymin':ymin, 'xmax':xmax, 'ymax':ymax}
-                    gt_bbox = gt_cbox['bbox']
-                    if do_bboxes_overlap(copied_bbox,gt_bbox)==True:
-                        does_overlap = True
-                        break
-                if not does_overlap:
-                    break                
+            # no room left for a box this size
+            position = occupancy.sample_free_position(width, height)
+            if position is None:
+                continue
+            xmin, ymin = position
+            xmax = xmin + width
+            ymax = ymin + height
 
             # Whiten background
             pad_px = 3
             white_background = fitz.Rect(xmin-pad_px, ymin-pad_px, xmax+pad_px, ymax+pad_px)
             cbox_boundary = fitz.Rect(xmin, ymin, xmax, ymax)
-            page.draw_rect(white_background, color=(1, 1, 1), fill=(1, 1, 1), width=0)
-            page.draw_rect(cbox_boundary, color=(0, 0, 0), width=random.uniform(1, 2))
+            emitter.rect(white_background, color=(1, 1, 1), fill=(1, 1, 1), width=0)
+            emitter.rect(cbox_boundary, color=(0, 0, 0), width=random.uniform(1, 2))
             
             r,g,b = 0,0,0
             if random.random()>0.4:
@@ -409,14 +756,17 @@ def add_random_checkboxes(page: fitz.Page, copy_paste: bool = True) -> tuple[fit
             r,g,b = r/256, g/256, b/256
             
             symbol = random.choice(["●", "◉", "✖", "X", "✔", "✓"])
-            page.insert_text((xmin, ymax), symbol, fontsize=font_size, color=(r,g,b), fontname=font)
+            emitter.text((xmin, ymax), symbol, fontsize=font_size, color=(r,g,b), fontname=font, fontfile=fontfile)
 
             gt[f"<cb_COPIED_{copied_idx}>"] = {
                 "widget_type": "checkbox",
                 "state": "checked",
                 "bbox": {"xmin": xmin, "ymin": ymin, "xmax": xmax, "ymax": ymax}
             }
+            occupancy.add(gt[f"<cb_COPIED_{copied_idx}>"]['bbox'])
 
+    if flush_emitter:
+        emitter.flush()
     return page, gt
 
 
@@ -468,105 +818,197 @@ def scale_coords(
     return json_data
 
 
-def generate_fake_data():
-    locales = [
-        'en_US', 'en_GB', 'en_CA', 'en_AU', 'en_NZ', 'en_IE',  # English-speaking
-        'en_IN', #'ja_JP', 'ko_KR', 'zh_CN', 'zh_TW',  # Asian
-        'fr_FR', 'de_DE', 'it_IT', 'nl_NL', 'pt_PT',  # European
-        'es_MX', 'es_ES', 'es_CO', 'es_AR', 'es_CL'  # Spanish-speaking (Latin America and Europe)
-    ]
-    fake = Faker()
-    
-    data_types = ['name', 'company', 'date', 'license', 'initials', 'address', 
-                    'sentence', 'county', 'city', 'country', 'number', 'word'
-                ]
+FAKER_LOCALES = [
+    'en_US', 'en_GB', 'en_CA', 'en_AU', 'en_NZ', 'en_IE',  # English-speaking
+    'en_IN', #'ja_JP', 'ko_KR', 'zh_CN', 'zh_TW',  # Asian
+    'fr_FR', 'de_DE', 'it_IT', 'nl_NL', 'pt_PT',  # European
+    'es_MX', 'es_ES', 'es_CO', 'es_AR', 'es_CL'  # Spanish-speaking (Latin America and Europe)
+]
 
-    fake_dict = {}
-    
-    for data_type in data_types:
-        if data_type == "name":
-            locale = random.choice(locales)
-            localized_fake = Faker(locale)
-            text = localized_fake.name()
-            text = remove_accents(text)
-            fake_dict[data_type] = text
+FAKE_DATA_TYPES = ['name', 'company', 'date', 'license', 'initials', 'address', 
+                   'sentence', 'county', 'city', 'country', 'number', 'word'
+                  ]
 
-        elif data_type == "company":
-            locale = random.choice(locales)
-            localized_fake = Faker(locale)
-            text = localized_fake.company()
-            text = remove_accents(text)
-            fake_dict[data_type] = text
-            
-        elif data_type == "date":
-            text = fake.date(pattern='%m/%d/%Y')
-            text = remove_accents(text)
-            fake_dict[data_type] = text
+# typical (min, max) length of each data type after remove_accents, as seen when
+# sampling the Faker providers; a heuristic, not a bound: values outside it do
+# occur (long addresses, say). Only used by generate_fake_text to decide which
+# types are worth generating for a given max_chars
+FAKE_DATA_LENGTHS = {
+    'name': (7, 42), 'company': (3, 55), 'date': (10, 10), 'license': (9, 9),
+    'initials': (4, 4), 'address': (18, 110), 'sentence': (12, 120), 'county': (3, 45),
+    'city': (3, 45), 'country': (3, 52), 'number': (1, 3), 'word': (1, 15),
+}
 
-        elif data_type == "license":
-            letters = ''.join(random.choices(string.ascii_uppercase, k=2))
-            digits = ''.join(random.choices(string.digits, k=7))
-            text = f"{letters}{digits}"
-            text = remove_accents(text)
-            fake_dict[data_type] = text
+# Building a Faker loads all of its locale providers, so each process keeps one
+# instance per locale instead of creating new ones per widget
+_faker_pool: dict[str | None, Faker] = {}
 
-        elif data_type == "initials":
-            locale = random.choice(locales)
-            localized_fake = Faker(locale)
-            text = f"{localized_fake.first_name()[0]}.{localized_fake.last_name()[0]}."
-            text = remove_accents(text)
-            fake_dict[data_type] = text
-        
-        elif data_type == "address":
-            locale = random.choice(locales)
-            localized_fake = Faker(locale)
-            text = localized_fake.address().replace("\n", ", ")
-            text = remove_accents(text)
-            fake_dict[data_type] = text
-        
-        elif data_type == "sentence":
-            text = fake.sentence(nb_words=random.randint(5, 12))
-            text = remove_accents(text)
-            fake_dict[data_type] = text
-        
-        elif data_type == "county" or data_type == "city":
-            locale = random.choice(locales)
-            localized_fake = Faker(locale)
-            text = localized_fake.city()
-            text = remove_accents(text)
-            fake_dict[data_type] = text
 
-        elif data_type == "country":
-            locale = random.choice(locales)
-            localized_fake = Faker(locale)
-            text = localized_fake.country()
-            text = remove_accents(text)
-            fake_dict[data_type] = text
+def get_faker(locale: str | None = None) -> Faker:
+    if locale not in _faker_pool:
+        fake = Faker(locale) if locale else Faker()
+        # it_IT builds its city list from a set, so its order would follow the
+        # interpreter's str hash seed; sorted, cities only depend on Faker's seed
+        for provider in fake.get_providers():
+            if type(provider).__module__ == 'faker.providers.address.it_IT':
+                provider.cities = sorted(provider.cities)
+        _faker_pool[locale] = fake
+    return _faker_pool[locale]
+
+
+def init_faker_pool(seed: int | None = None) -> None:
+    # pooled instances share Faker's class-level random, so one seed covers all of them
+    for locale in [None] + FAKER_LOCALES:
+        get_faker(locale)
+    if seed is not None:
+        Faker.seed(seed)
+
+
+def generate_fake_value(data_type: str) -> str:
+    if data_type == "name":
+        text = get_faker(random.choice(FAKER_LOCALES)).name()
+
+    elif data_type == "company":
+        text = get_faker(random.choice(FAKER_LOCALES)).company()
+
+    elif data_type == "date":
+        text = get_faker().date(pattern='%m/%d/%Y')
+
+    elif data_type == "license":
+        letters = ''.join(random.choices(string.ascii_uppercase, k=2))
+        digits = ''.join(random.choices(string.digits, k=7))
+        text = f"{letters}{digits}"
+
+    elif data_type == "initials":
+        localized_fake = get_faker(random.choice(FAKER_LOCALES))
+        text = f"{localized_fake.first_name()[0]}.{localized_fake.last_name()[0]}."
+
+    elif data_type == "address":
+        text = get_faker(random.choice(FAKER_LOCALES)).address().replace("\n", ", ")
+
+    elif data_type == "sentence":
+        text = get_faker().sentence(nb_words=random.randint(5, 12))
+
+    elif data_type == "county" or data_type == "city":
+        text = get_faker(random.choice(FAKER_LOCALES)).city()
+
+    elif data_type == "country":
+        text = get_faker(random.choice(FAKER_LOCALES)).country()
+
+    elif data_type == "number":
+        return str(random.randint(1, 100))
+
+    elif data_type == "word":
+        text = get_faker(random.choice(FAKER_LOCALES)).word()
+
+    return remove_accents(text)
+
+
+_fake_value_bank = None
+
+
+def get_fake_value_bank() -> FakeValueBank:
+    global _fake_value_bank
+    if _fake_value_bank is None:
+        _fake_value_bank = FakeValueBank(FAKE_VALUE_BANK_PATH)
+    return _fake_value_bank
+
+
+def build_fake_value_bank(path: Path, values_per_type: int, seed: int) -> None:
+    # run once before rendering; 'text' mixes all data types so that a length lookup
+    # behaves like select_text_widthwise over a fresh fake_dict
+    random.seed(seed)
+    init_faker_pool(seed)
+    text_values = [generate_fake_value(data_type)
+                   for data_type in FAKE_DATA_TYPES
+                   for _ in range(values_per_type)]
+    first_names = [get_faker(random.choice(FAKER_LOCALES)).first_name()
+                   for _ in range(values_per_type)]
+    write_fake_value_bank(path, {'text': text_values, 'first_name': first_names},
+                          get_fake_value_bank_params(values_per_type, seed))
+
+
+def get_fake_value_bank_params(values_per_type: int, seed: int) -> dict:
+    # everything the values of a bank depend on, the code drawing them included
+    code = ''.join(inspect.getsource(function) for function in
+                   (get_faker, generate_fake_value, remove_accents, build_fake_value_bank))
+    return {
+        'values_per_type': values_per_type,
+        'seed': seed,
+        'faker': FAKER_VERSION,
+        'locales': FAKER_LOCALES,
+        'data_types': FAKE_DATA_TYPES,
+        'code': hashlib.sha256(code.encode()).hexdigest(),
+    }
+
+
+def is_fake_value_bank_current(path: Path, values_per_type: int, seed: int) -> bool:
+    return path.exists() and read_fake_value_bank_params(path) == get_fake_value_bank_params(values_per_type, seed)
 
-        elif data_type == "number":
-            text = str(random.randint(1, 100))
-            fake_dict[data_type] = text
-        
-        elif data_type == "word":
-            locale = random.choice(locales)
-            localized_fake = Faker(locale)
-            text = localized_fake.word()
-            text = remove_accents(text)
-            fake_dict[data_type] = text
-            
-    return fake_dict
 
+def ensure_fake_value_bank(path: Path, values_per_type: int, seed: int) -> None:
+    """Builds the bank at 'path' unless it exists and was built with the same parameters."""
+    if not is_fake_value_bank_current(path, values_per_type, seed):
+        print(f'building fake value bank {path}')
+        build_fake_value_bank(path, values_per_type, seed)
 
-def add_fake_textfield_data(page: fitz.Page) -> tuple[fitz.Page, dict[str, str]]:
+
+def generate_fake_data() -> dict[str, str]:
+    return {data_type: generate_fake_value(data_type) for data_type in FAKE_DATA_TYPES}
+
+
+def generate_fake_text(max_chars: int) -> str:
+    """
+    Fake text for a field of 'max_chars': one value per data type, types tried in
+    order of how close their typical lengths (FAKE_DATA_LENGTHS) come to
+    max_chars, keeping the first value closest in length to max_chars, until the
+    typical lengths of the next type can not come closer. Too long a value is cut
+    as in select_text_widthwise.
+
+    The values are of the kind select_text_widthwise(generate_fake_data(),
+    max_chars) picks, but not the same ones: the generators are drawn in another
+    order, ties go to another type, and a type whose value would have come
+    closer than its typical lengths suggest is not generated at all.
+    """
+    def length_gap(data_type):
+        min_len, max_len = FAKE_DATA_LENGTHS[data_type]
+        return max(min_len - max_chars, max_chars - max_len, 0)
+
+    min_len_diff = 10000
+    min_dif_text = ''
+    for data_type in sorted(FAKE_DATA_TYPES, key=length_gap):
+        if length_gap(data_type) >= min_len_diff:
+            break
+        text = generate_fake_value(data_type)
+        len_diff = abs(len(text) - max_chars)
+        if len_diff < min_len_diff:
+            min_len_diff = len_diff
+            min_dif_text = text
+
+    if len(min_dif_text)>=max_chars:
+        return min_dif_text[:max_chars - 2]
+
+    return min_dif_text
+
+
+def add_fake_textfield_data(page: fitz.Page, widgets: list | None = None,
+                            emitter: PageEmitter | None = None) -> tuple[fitz.Page, dict[str, str]]:
     gt = {}
-    for widget in page.widgets():
-        widget_name = widget.field_name
-        widget_type = widget.field_type_string
+    if widgets is None:
+        widgets = extract_page_widgets(page)
+
+    flush_emitter = emitter is None
+    if flush_emitter:
+        emitter = PageEmitter(page)
+
+    for widget in widgets:
+        widget_name = widget.name
+        widget_type = widget.type_string
         
         if widget_type!='Text':
             continue
               
-        xmin, ymin, xmax, ymax = widget.rect.x0, widget.rect.y0, widget.rect.x1, widget.rect.y1
+        xmin, ymin, xmax, ymax = widget.rect
         width = xmax-xmin
 
         if random.random() < 0.2:
@@ -589,11 +1031,16 @@ def add_fake_textfield_data(page: fitz.Page) -> tuple[fitz.Page, dict[str, str]]
         char_size = random.choice([7,8,9])
         max_chars =int(width / (char_size * (font_size / 13)))
         
-        fake_dict = generate_fake_data()
-        text = select_text_widthwise(fake_dict, max_chars)
+        if USE_FAKE_VALUE_BANK:
+            text = get_fake_value_bank().pick(max_chars)
+        elif LAZY_FAKE_DATA:
+            text = generate_fake_text(max_chars)
+        else:
+            fake_dict = generate_fake_data()
+            text = select_text_widthwise(fake_dict, max_chars)
 
         x, y = get_xstart_ystart('textfield', text, xmin, ymin, xmax, ymax, font_size)
-        page.insert_text((x, y), text, fontname=font_name, fontsize=font_size, color=(r, g, b))
+        emitter.text((x, y), text, fontname=font_name, fontsize=font_size, color=(r, g, b))
         
         gt[widget_name] = {
                 "widget_type": "textfield",
@@ -601,6 +1048,8 @@ def add_fake_textfield_data(page: fitz.Page) -> tuple[fitz.Page, dict[str, str]]
                 "bbox": {"xmin": xmin, "ymin": ymin, "xmax": xmax, "ymax": ymax}
             }
         
+    if flush_emitter:
+        emitter.flush()
     return page, gt
 
 
@@ -799,14 +1248,212 @@ def add_fake_textfield_data_bak(page: fitz.Page) -> tuple[fitz.Page, dict[str, s
     return page, gt
 
 
-def add_fake_data(page: fitz.Page) -> tuple[fitz.Page, dict]:
-    page, gt_checkboxes = add_random_checkboxes(page, copy_paste=True)
-    page, gt_textfield = add_fake_textfield_data(page)
-    page, gt_signatures = add_signatures_to_textfields(page, signature_enclosure_dir)
+def add_fake_data(page: fitz.Page, widgets: list | None = None, image_xrefs: dict | None = None,
+                  delete_widgets: bool = True) -> tuple[fitz.Page, dict]:
+    if widgets is None:
+        widgets = extract_page_widgets(page)
+    # checkbox and textfield content goes in one batch; signature images are
+    # inserted as they are placed, so their names are batched after them
+    emitter = PageEmitter(page)
+    page, gt_checkboxes = add_random_checkboxes(page, copy_paste=True, widgets=widgets, emitter=emitter,
+                                                delete_widgets=delete_widgets)
+    page, gt_textfield = add_fake_textfield_data(page, widgets, emitter)
+    emitter.flush()
+    page, gt_signatures = add_signatures_to_textfields(page, signature_enclosure_dir, widgets, image_xrefs, emitter)
+    emitter.flush()
     gt = {**gt_checkboxes, **gt_textfield, **gt_signatures} 
     return page, gt
 
 
+def get_unit_seed(pdf_name: str, page_num: int, sample_no: int, global_seed: int) -> int:
+    # seed depends only on what the unit is, never on which worker runs it or when
+    key = f"{pdf_name}|{page_num}|{sample_no}|{global_seed}".encode()
+    return int.from_bytes(hashlib.sha256(key).digest()[:8], 'big')
+
+
+def seed_unit(seed: int) -> None:
+    random.seed(seed)
+    init_faker_pool(seed)
+
+
+_crop_stage = None
+
+
+def get_crop_stage():
+    # 1_crop_images_vertically.py, for its tile layout and annotation rules; its
+    # file name is not a valid module name, so it is loaded from its path
+    global _crop_stage
+    if _crop_stage is None:
+        path = Path(__file__).parent / '1_crop_images_vertically.py'
+        spec = importlib.util.spec_from_file_location('stage_crop', path)
+        _crop_stage = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(_crop_stage)
+    return _crop_stage
+
+
+def get_tile_offsets(unit: tuple[Path, int, int], tile_height: int) -> list[int]:
+    # the offsets 1_crop_images_vertically.py draws for this unit's image, seeded the same way
+    pdf_path, page_num, sample_no = unit
+    stage_crop = get_crop_stage()
+    random.seed(f'{pdf_path.name}/image/{page_num+1}_{sample_no}.jpg|{stage_crop.SEED}')
+    return [offset for offset, _ in stage_crop.get_vertical_crop_offsets(PAGE_HEIGHT, tile_height)]
+
+
+def rasterize_sample(page: fitz.Page, gt: dict, unit: tuple[Path, int, int], tile_height: int | None,
+                     background: np.ndarray | None = None) -> tuple[np.ndarray | list[np.ndarray], dict | list[dict]]:
+    if tile_height is None:
+        return get_page_raster(page, PAGE_WIDTH, PAGE_HEIGHT, background=background), gt
+
+    offsets = get_tile_offsets(unit, tile_height)
+    if page.rotation == 0:
+        tiles = get_page_tiles(page, PAGE_WIDTH, PAGE_HEIGHT, offsets, tile_height, background=background)
+    else:
+        # clip rectangles are in unrotated page space; rotated pages are cut from a full raster
+        img = get_page_raster(page, PAGE_WIDTH, PAGE_HEIGHT, background=background)
+        tiles = [img[offset:offset + tile_height] for offset in offsets]
+    stage_crop = get_crop_stage()
+    return tiles, stage_crop.adjust_widget_bboxes_batch(gt, offsets, tile_height)
+
+
+def render_sample(unit: tuple[Path, int, int], seed: int | None = None,
+                  tile_height: int | None = None) -> tuple[np.ndarray | list[np.ndarray], dict | list[dict], bytes | None]:
+    """
+    Fills and rasterizes one (pdf, page, sample) work unit in memory, seeded with
+    'seed' or, by default, the unit's own seed.
+    Returns the image, its widget annotations and the filled page as a
+    single-page PDF (None if SAVE_PDFS is off). With 'tile_height', the page is
+    rendered straight into the tiles 1_crop_images_vertically.py would cut from
+    the image, and the image and annotations are lists with one entry per tile.
+    """
+    pdf_path, page_num, sample_no = unit
+    if seed is None:
+        seed = get_unit_seed(pdf_path.name, page_num, sample_no, GLOBAL_SEED)
+    seed_unit(seed)
+
+    doc = open_template(pdf_path)
+    page = doc.load_page(page_num)
+    widgets = get_template_widgets(pdf_path)[page_num]
+    delete_checkbox_widgets(page)
+
+    if CACHE_PAGE_BACKGROUNDS and page.rotation == 0:
+        # fill content goes on a blank page of the same size, which is rendered
+        # with transparency over the cached template raster and, for the saved
+        # PDFs, stamped onto the template page
+        overlay_doc = fitz.open()
+        overlay = overlay_doc.new_page(width=page.rect.width, height=page.rect.height)
+        overlay, gt = add_fake_data(overlay, widgets, delete_widgets=False)
+        gt = scale_coords(gt, page, PAGE_WIDTH, PAGE_HEIGHT)
+        background = get_page_background(pdf_path, page_num, PAGE_WIDTH, PAGE_HEIGHT)
+        img, gt = rasterize_sample(overlay, gt, unit, tile_height, background)
+        if SAVE_PDFS:
+            page.show_pdf_page(page.rect, overlay_doc, 0)
+        overlay_doc.close()
+    else:
+        page, gt = add_fake_data(page, widgets, delete_widgets=False)
+        gt = scale_coords(gt, page, PAGE_WIDTH, PAGE_HEIGHT)
+        img, gt = rasterize_sample(page, gt, unit, tile_height)
+
+    page_pdf = None
+    if SAVE_PDFS:
+        page_doc = fitz.open()
+        page_doc.insert_pdf(doc, from_page=page_num, to_page=page_num)
+        # TextWriter embeds whole font programs, base-14 ones included; keep only
+        # the glyphs this page uses
+        page_doc.subset_fonts()
+        page_pdf = page_doc.tobytes(no_new_id=True)
+        page_doc.close()
+    doc.close()
+
+    return img, gt, page_pdf
+
+
+def generate_sample(unit: tuple[Path, int, int]) -> tuple[str, int, int, bytes | None, list[tuple[str, bytes | np.ndarray, dict]] | None]:
+    """
+    Renders one (pdf, page, sample) work unit and writes its image and json, or
+    with RENDER_CROP_TILES its tiles and their jsons.
+    Returns the filled page as a single-page PDF (or None if SAVE_PDFS is off)
+    so the parent can assemble the synthetic sample PDFs in page order. With
+    OUTPUT_SHARDS the images are returned as (stem, jpeg_bytes, gt) instead of
+    written, since only the parent writes to the shards, and with OUTPUT_RASTERS
+    as (stem, image, gt).
+    """
+    pdf_path, page_num, sample_no = unit
+    pdf_name = pdf_path.name
+    if RENDER_CROP_TILES:
+        tiles, tile_gts, page_pdf = render_sample(unit, tile_height=get_crop_stage().CROP_HEIGHT)
+        samples = [(f'{page_num+1}_{sample_no}_crop_{i}', tile, tile_gt)
+                   for i, (tile, tile_gt) in enumerate(zip(tiles, tile_gts))]
+    else:
+        img, gt, page_pdf = render_sample(unit)
+        samples = [(f'{page_num+1}_{sample_no}', img, gt)]
+    if WRITE_IMAGE_SIZE:
+        samples = [(stem, img, with_image_size(gt, img)) for stem, img, gt in samples]
+
+    if OUTPUT_RASTERS:
+        # plain arrays; the pixmaps behind the images stay in this process
+        return pdf_name, page_num, sample_no, page_pdf, [(stem, np.asarray(img), gt) for stem, img, gt in samples]
+    if OUTPUT_SHARDS:
+        return pdf_name, page_num, sample_no, page_pdf, [(stem, encode_image(img), gt) for stem, img, gt in samples]
+
+    for stem, img, gt in samples:
+        with open(out_dir/pdf_name/"json"/f'{stem}.json', 'w') as f:
+            json.dump(gt, f, indent=4)
+        cv2.imwrite(out_dir/pdf_name/"image"/f'{stem}.jpg', img)
+
+    # for field_name, entry in gt.items():
+    #     bbox = entry['bbox']
+    #     xmin, ymin, xmax, ymax = bbox['xmin'], bbox['ymin'], bbox['xmax'], bbox['ymax']
+    #     xmin, ymin, xmax, ymax = int(xmin), int(ymin), int(xmax), int(ymax)
+    #     cv2.rectangle(img, (xmin, ymin), (xmax, ymax), (0, 255, 0), 2)
+
+    # cv2.imwrite(out_dir/pdf_name/"plot"/f'{page_num+1}_{sample_no}_bbox.jpg', img)
+
+    return pdf_name, page_num, sample_no, page_pdf, None
+
+
+def get_work_units(pdf_paths: list[Path]) -> tuple[list[tuple[Path, int, int]], dict[str, int]]:
+    # builds or refreshes each template's widget index before any worker needs it;
+    # units come page by page, so SAMPLES_PER_PAGE consecutive units share a page
+    page_counts = {pdf_path.name: len(get_template_widgets(pdf_path)) for pdf_path in pdf_paths}
+    units = [(pdf_path, page_num, sample_no)
+             for pdf_path in pdf_paths
+             for page_num in range(page_counts[pdf_path.name])
+             for sample_no in range(SAMPLES_PER_PAGE)]
+    return units, page_counts
+
+
+def get_template_inputs(pdf_path: Path) -> list[Path]:
+    # everything a template's samples are drawn from, for the output manifest
+    inputs = [pdf_path]
+    inputs += sorted(font_dir.iterdir())
+    inputs += sorted(signature_enclosure_dir.iterdir())
+    if USE_FAKE_VALUE_BANK:
+        inputs.append(FAKE_VALUE_BANK_PATH)
+    return inputs
+
+
+def save_synthetic_pdfs(pdf_name: str, page_pdfs: dict[tuple[int, int], bytes], page_nums: int) -> None:
+    # page_pdfs is keyed by (sample_no, page_num) and may have been filled in any order
+    for sample_no in range(SAMPLES_PER_PAGE):
+        synthetic_pdf = fitz.open()
+        for page_num in range(page_nums):
+            with fitz.open(stream=page_pdfs[(sample_no, page_num)], filetype='pdf') as page_doc:
+                synthetic_pdf.insert_pdf(page_doc)
+
+        out_pdf_path = out_dir / pdf_name / "pdf" / f'sample_{sample_no}.pdf'
+        os.makedirs(out_pdf_path.parent, exist_ok=True)
+        for page in synthetic_pdf:
+            for widget in page.widgets():
+                page.delete_widget(widget)
+        # pages were filled in separate documents, so each has its own copy of
+        # the signature images and fonts; garbage=4 compares streams as well and
+        # merges identical ones back into single objects (garbage=3 only merges
+        # objects without a stream)
+        synthetic_pdf.save(out_pdf_path, garbage=4, deflate=True, no_new_id=True)
+        synthetic_pdf.close()
+        print(f'saved syn pdf {sample_no+1}/{SAMPLES_PER_PAGE}')
+
+
 PAGE_WIDTH, PAGE_HEIGHT = 2048, 2650
 SAMPLES_PER_PAGE = 5
 SUPPORTED_TYPES = ['checkbox', 'name', 'company', 'date', 'license', 'county', 'city', 
@@ -815,65 +1462,156 @@ SUPPORTED_TYPES = ['checkbox', 'name', 'company', 'date', 'license', 'county', '
 
 SAVE_PDFS = True
 
+# write the images and jsons into tar shards in out_dir (see sample_shards.py)
+# instead of one file each; the next stages read either. Shards are always
+# written from scratch, so INCREMENTAL only applies to plain files
+OUTPUT_SHARDS = False
+
+# write the images undecoded into memory-mapped packs in out_dir (see raw_raster.py)
+# instead, so stages 1 and 2 read them without a JPEG round trip; JPEGs are then
+# only encoded by the last stage. Like shards, always written from scratch
+OUTPUT_RASTERS = False
+
+# store every image's size in its json (see image_meta.py); the next stages
+# keep it up to date and the COCO/YOLO converters take it from there instead
+# of reading the images
+WRITE_IMAGE_SIZE = False
+
+# render every sample straight into the tiles 1_crop_images_vertically.py would
+# cut from it (same offsets, seed and annotation rules, its CROP_HEIGHT) instead
+# of the full page; the tiles go to stage 1's output directory and stage 1 is
+# skipped. Saves encoding, decoding and re-encoding the full page
+RENDER_CROP_TILES = False
+
+# rasterize each template page (checkbox widgets removed) once per process and
+# composite every sample's fill content onto it instead of rendering the whole
+# page per sample; rotated pages are always rendered in full. Off by default:
+# anti-aliased edges where fill content meets the template round slightly
+# differently, so the images are not byte-identical to full renders
+CACHE_PAGE_BACKGROUNDS = False
+
+# only generate the fake data types that can come close to a textfield's max_chars
+# instead of all of them (see generate_fake_text); faster, but the values are
+# not the ones generate_fake_data + select_text_widthwise would pick
+LAZY_FAKE_DATA = False
+
+# pick textfield values and signature names from a pre-built, memory-mapped bank
+# (fake_value_bank.py) instead of calling Faker while rendering; the bank is built
+# before the first run that needs it, and again when FAKE_VALUES_PER_TYPE, the
+# seed, Faker or the generating code change, and shared by all workers
+USE_FAKE_VALUE_BANK = False
+FAKE_VALUE_BANK_PATH = Path('out_fake_value_bank.bin')
+FAKE_VALUES_PER_TYPE = 20000
+
+# Work units are (pdf, page, sample); with NUM_WORKERS > 1 they are spread over a
+# process pool. Each unit is seeded from (template name, page, sample, GLOBAL_SEED),
+# so the outputs are identical whatever the worker count.
+NUM_WORKERS = 1
+GLOBAL_SEED = 0
+
+# keep out_dir between runs and only regenerate the templates whose inputs, or
+# this stage's settings, changed since the last run (see stage_manifest.py);
+# outputs of templates that were removed are deleted
+INCREMENTAL = True
+
+# templates whose bytes each worker keeps in memory (see open_template)
+TEMPLATE_POOL_SIZE = 4
+
 template_pdf_dir = Path('TEMPLATE_PDF/annotated_pdfs')
 pdf_paths = list(template_pdf_dir.rglob('*.pdf'))
 
 signature_enclosure_dir = Path('TEMPLATE_PDF/signature_enclosures')
-out_dir = Path('out_0_random_images')
-shutil.rmtree(out_dir, ignore_errors=True)
-os.makedirs(out_dir)
-# exit()
-for idx, pdf_path in enumerate(pdf_paths):
-    pdf_name = pdf_path.name    
-    page_nums = len(fitz.open(str(pdf_path)))
-
-    os.makedirs(out_dir/pdf_name/"image", exist_ok=True)
-    os.makedirs(out_dir/pdf_name/"json", exist_ok=True)
-    # os.makedirs(out_dir/pdf_name/"plot", exist_ok=True)
-    
-    if SAVE_PDFS:
-        synthetic_pdfs = [fitz.open() for i in range(SAMPLES_PER_PAGE)]
-    
-    sample_docs = [fitz.open(str(pdf_path)) for _ in range(SAMPLES_PER_PAGE)]
-    for page_num in range(page_nums):
-        
-        for sample_no in range(SAMPLES_PER_PAGE):
-            print(f"{idx+1}/{len(pdf_paths)} {page_num+1}/{page_nums} {sample_no+1}/{SAMPLES_PER_PAGE}  {pdf_path}")
-        
-            doc = sample_docs[sample_no]
-            page = doc.load_page(page_num)
-            
-            page, gt = add_fake_data(page)
-            gt = scale_coords(gt, page, PAGE_WIDTH, PAGE_HEIGHT)
-            img = get_page_raster(page, PAGE_WIDTH, PAGE_HEIGHT)
-            
-            if SAVE_PDFS:
-                synthetic_pdfs[sample_no].insert_pdf(doc, from_page=page_num, to_page=page_num)
-
-            json.dump(gt, open(out_dir/pdf_name/"json"/f'{page_num+1}_{sample_no}.json', 'w'), indent=4)
-            cv2.imwrite(out_dir/pdf_name/"image"/f'{page_num+1}_{sample_no}.jpg', img)
-
-            # for field_name, entry in gt.items():
-            #     bbox = entry['bbox']
-            #     xmin, ymin, xmax, ymax = bbox['xmin'], bbox['ymin'], bbox['xmax'], bbox['ymax']
-            #     xmin, ymin, xmax, ymax = int(xmin), int(ymin), int(xmax), int(ymax)
-            #     cv2.rectangle(img, (xmin, ymin), (xmax, ymax), (0, 255, 0), 2)
-
-            # cv2.imwrite(out_dir/pdf_name/"plot"/f'{page_num+1}_{sample_no}_bbox.jpg', img)
-    
-    for doc in sample_docs:
-        doc.close()       
-    
-    if SAVE_PDFS:
-        for idx, synthetic_pdf in enumerate(synthetic_pdfs):
-            out_pdf_path = out_dir / pdf_name / "pdf" / f'sample_{idx}.pdf'
-            os.makedirs(out_pdf_path.parent, exist_ok=True)
-            for page in synthetic_pdf:
-                for widget in page.widgets():
-                    page.delete_widget(widget)
-            synthetic_pdf.save(out_pdf_path)
-            synthetic_pdf.close()
-            print(f'saved syn pdf {idx+1}/{len(synthetic_pdfs)}')
-
-        
-print('Done...!')
\ No newline at end of file
+font_dir = Path('TEMPLATE_PDF/fonts')
+widget_index_dir = Path('TEMPLATE_PDF/widget_index')
+out_dir = Path('out_1_cropped_images') if RENDER_CROP_TILES else Path('out_0_random_images')
+
+if __name__ == '__main__':
+    # shards and raster packs are always written from scratch and no manifest
+    # is kept next to them, so the next plain-file run finds none and clears
+    # them away
+    sharded = OUTPUT_SHARDS or OUTPUT_RASTERS
+    manifest = open_manifest(out_dir, {
+        'code': [get_file_digest(__file__), get_file_digest(inspect.getfile(FakeValueBank))],
+        'page_size': [PAGE_WIDTH, PAGE_HEIGHT],
+        'samples_per_page': SAMPLES_PER_PAGE,
+        'save_pdfs': SAVE_PDFS,
+        'output_shards': OUTPUT_SHARDS,
+        'output_rasters': OUTPUT_RASTERS,
+        'image_size': WRITE_IMAGE_SIZE,
+        'crop_tiles': [get_file_digest(inspect.getfile(get_crop_stage())), get_crop_stage().CROP_HEIGHT,
+                       get_crop_stage().SEED] if RENDER_CROP_TILES else None,
+        'cache_page_backgrounds': CACHE_PAGE_BACKGROUNDS,
+        'lazy_fake_data': LAZY_FAKE_DATA,
+        'fake_value_bank': [USE_FAKE_VALUE_BANK, FAKE_VALUES_PER_TYPE],
+        'seed': GLOBAL_SEED,
+    }, INCREMENTAL and not sharded)
+
+    if USE_FAKE_VALUE_BANK:
+        ensure_fake_value_bank(FAKE_VALUE_BANK_PATH, FAKE_VALUES_PER_TYPE, GLOBAL_SEED)
+
+    template_inputs = {pdf_path.name: get_template_inputs(pdf_path) for pdf_path in pdf_paths}
+    for pdf_name in manifest.prune(template_inputs):
+        print(f'removed outputs of {pdf_name}')
+    stale_paths = [pdf_path for pdf_path in pdf_paths
+                   if not manifest.is_current(pdf_path.name, template_inputs[pdf_path.name])]
+    for pdf_path in stale_paths:
+        manifest.discard(pdf_path.name)
+        shutil.rmtree(out_dir/pdf_path.name, ignore_errors=True)
+    if not sharded:
+        manifest.save()
+    print(f'{len(pdf_paths) - len(stale_paths)}/{len(pdf_paths)} templates up to date')
+
+    units, page_counts = get_work_units(stale_paths)
+    for pdf_path in stale_paths:
+        if not sharded:
+            os.makedirs(out_dir/pdf_path.name/"image", exist_ok=True)
+            os.makedirs(out_dir/pdf_path.name/"json", exist_ok=True)
+        # os.makedirs(out_dir/pdf_path.name/"plot", exist_ok=True)
+
+    # fork, so the workers start from the module as the parent configured it;
+    # shards and raster packs are filled in work unit order, so their contents do
+    # not depend on the worker count. A chunk is one page's samples, so a worker
+    # renders a page's background once (see get_page_background) for all of them
+    pool = multiprocessing.get_context('fork').Pool(NUM_WORKERS) if NUM_WORKERS > 1 else None
+    if pool:
+        pool_map = pool.imap if sharded else pool.imap_unordered
+        results = pool_map(generate_sample, units, chunksize=SAMPLES_PER_PAGE)
+    else:
+        results = map(generate_sample, units)
+    if OUTPUT_RASTERS:
+        shard_writer = RasterWriter(out_dir)
+    elif OUTPUT_SHARDS:
+        shard_writer = ShardWriter(out_dir)
+    else:
+        shard_writer = None
+
+    pending_pdfs = {}
+    remaining = {pdf_name: page_nums * SAMPLES_PER_PAGE for pdf_name, page_nums in page_counts.items()}
+    for idx, (pdf_name, page_num, sample_no, page_pdf, samples) in enumerate(results):
+        page_nums = page_counts[pdf_name]
+        print(f"{idx+1}/{len(units)} {page_num+1}/{page_nums} {sample_no+1}/{SAMPLES_PER_PAGE}  {pdf_name}")
+
+        if shard_writer:
+            for stem, image, gt in samples:
+                shard_writer.write(f'{pdf_name}/{stem}', image, gt)
+
+        if SAVE_PDFS:
+            page_pdfs = pending_pdfs.setdefault(pdf_name, {})
+            page_pdfs[(sample_no, page_num)] = page_pdf
+            if len(page_pdfs) == page_nums * SAMPLES_PER_PAGE:
+                save_synthetic_pdfs(pdf_name, pending_pdfs.pop(pdf_name), page_nums)
+
+        # a template only counts as done once all of its samples are written, so
+        # an interrupted run redoes it
+        remaining[pdf_name] -= 1
+        if remaining[pdf_name] == 0 and not sharded:
+            manifest.record(pdf_name, template_inputs[pdf_name], [pdf_name])
+            manifest.save()
+
+    if pool:
+        pool.close()
+        pool.join()
+    if shard_writer:
+        shard_writer.close()
+
+    print('Done...!')
@@ -2,27 +2,32 @@ import os
 import cv2
 import json
 import random
+import itertools
+import multiprocessing
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-import shutil
+from stage_manifest import get_file_digest, open_manifest
+from sample_shards import SampleWriter, decode_image, encode_image, image_relpath, is_shard_dir, read_samples
+from raw_raster import RasterWriter, is_raster_dir, read_rasters
+from image_meta import IMAGE_KEY, with_image_size
 
-def crop_image_vertically(image, crop_height):
+def get_vertical_crop_offsets(img_h, crop_height, rng=random):
     """
-    Crop the image into multiple vertical tiles, each of height 'crop_height',
-    with random overlap controlled by 'shift'.
-    Returns a list of (cropped_image, offset_y, shift).
+    Top offsets of the vertical tiles, each of height 'crop_height', cut from an
+    image 'img_h' pixels high, with random overlap controlled by 'shift' (drawn
+    from 'rng', the random module by default).
+    Returns a list of (offset_y, shift).
     """
-    img_h, img_w = image.shape[:2]
-    crops = []
+    offsets = []
     y = 0
     while y < img_h:
         # Random shift for overlap
-        shift = random.randint(int(0.01 * img_h), int(0.1 * img_h))
+        shift = rng.randint(int(0.01 * img_h), int(0.1 * img_h))
 
         # Crop from y to y + crop_height
-        cropped = image[y : y + crop_height, :]
-
-        # Append: (the cropped tile, the top offset y, and shift)
-        crops.append((cropped, y, shift))
+        offsets.append((y, shift))
 
         # Move 'y' downward, leaving some overlap
         y += max(1, crop_height - shift)
@@ -33,11 +38,20 @@ def crop_image_vertically(image, crop_height):
             # If final_offset < 0, it means the image is smaller than crop_height
             if final_offset < 0:
                 final_offset = 0
-            cropped = image[final_offset : final_offset + crop_height, :]
-            crops.append((cropped, final_offset, 0))
+            offsets.append((final_offset, 0))
             break
 
-    return crops
+    return offsets
+
+def crop_image_vertically(image, crop_height, rng=random):
+    """
+    Crop the image into multiple vertical tiles, each of height 'crop_height',
+    with random overlap controlled by 'shift'.
+    Returns a list of (cropped_image, offset_y, shift).
+    """
+    img_h = image.shape[0]
+    return [(image[y : y + crop_height, :], y, shift)
+            for y, shift in get_vertical_crop_offsets(img_h, crop_height, rng)]
 
 
 def adjust_bboxes_single(widget_dict, offset_y, crop_height, visibility=0.5):
@@ -99,15 +113,79 @@ def adjust_widget_bboxes(widgets, offset_y, crop_height):
 
     return updated
 
-def process_image(image_path, json_path, out_dir, crop_height):
+def adjust_widget_bboxes_batch(widgets, offsets, crop_height, visibility=0.5):
+    """
+    adjust_widget_bboxes for several crop offsets at once: the textfield and
+    visibility rules and the clamping of adjust_bboxes_single are evaluated for
+    every widget and every offset in one array operation.
+    Returns one updated widgets dict per offset.
+    """
+    items = list(widgets.items())
+    has_bbox = np.array(['bbox' in widget_dict for _, widget_dict in items], dtype=bool)
+    bbox_ys = [(widget_dict['bbox']['ymin'], widget_dict['bbox']['ymax'])
+               for _, widget_dict in items if 'bbox' in widget_dict]
+    if not all(type(y) is int for ys in bbox_ys for y in ys):
+        # float coordinates: the one-by-one version keeps their exact types
+        return [adjust_widget_bboxes(widgets, offset_y, crop_height) for offset_y in offsets]
+
+    # (N,) per widget, widgets without a bbox at 0 and always kept
+    ymin = np.zeros(len(items), dtype=np.int64)
+    ymax = np.zeros(len(items), dtype=np.int64)
+    if bbox_ys:
+        ymin[has_bbox], ymax[has_bbox] = np.array(bbox_ys, dtype=np.int64).T
+    is_textfield = np.array([has and widget_dict['widget_type'] == 'textfield'
+                             for has, (_, widget_dict) in zip(has_bbox, items)], dtype=bool)
+
+    # (C, N): one row per crop offset
+    offset_y = np.asarray(offsets, dtype=np.int64)[:, None]
+    intersection_ymin = np.maximum(ymin, offset_y)
+    intersection_ymax = np.minimum(ymax, offset_y + crop_height)
+    visible_height = np.maximum(0, intersection_ymax - intersection_ymin)
+    bbox_height = ymax - ymin
+    with np.errstate(divide='ignore', invalid='ignore'):
+        keep = (bbox_height > 0) & (visible_height / bbox_height >= visibility)
+    # if the underline of the textfield is not visible, then skip
+    keep &= ~(is_textfield & ((ymax < offset_y) | (ymax > offset_y + crop_height)))
+    keep |= ~has_bbox
+
+    new_ymin = np.maximum(0, intersection_ymin - offset_y).tolist()
+    new_ymax = np.minimum(crop_height, intersection_ymax - offset_y).tolist()
+
+    updated_per_crop = []
+    for c, crop_keep in enumerate(keep):
+        updated = {}
+        for i in np.flatnonzero(crop_keep).tolist():
+            widget_name, widget_dict = items[i]
+            if has_bbox[i]:
+                new_value = widget_dict.copy()
+                new_value['bbox'] = {**widget_dict['bbox'], 'ymin': new_ymin[c][i], 'ymax': new_ymax[c][i]}
+                widget_dict = new_value
+            updated[widget_name] = widget_dict
+        updated_per_crop.append(updated)
+    return updated_per_crop
+
+def crop_sample(image, widgets, crop_height, rng=random):
+    """
+    Crops the image into vertical tiles and adjusts the widget bboxes to each tile.
+    An image size stored in the widgets (see image_meta.py) becomes the tile's.
+    Returns a list of (cropped_image, updated_widgets).
+    """
+    crops = crop_image_vertically(image, crop_height, rng)
+    updated = adjust_widget_bboxes_batch(widgets, [offset_y for _, offset_y, _ in crops], crop_height)
+    if IMAGE_KEY in widgets:
+        updated = [with_image_size(crop_widgets, crop) for (crop, _, _), crop_widgets in zip(crops, updated)]
+    return [(crop, crop_widgets) for (crop, _, _), crop_widgets in zip(crops, updated)]
+
+def process_image(image_path, json_path, out_dir, crop_height, rng=random):
     """
     Reads the image and JSON, performs vertical cropping, and writes out
     the cropped images and their updated JSON files.
+    Returns the written files, relative to 'out_dir'.
     """
     image = cv2.imread(str(image_path))
     if image is None:
         print(f"Could not read image: {image_path}")
-        return
+        return []
 
     with open(json_path, 'r') as f:
         widgets = json.load(f)
@@ -121,46 +199,174 @@ def process_image(image_path, json_path, out_dir, crop_height):
     os.makedirs(img_out_dir, exist_ok=True)
     os.makedirs(json_out_dir, exist_ok=True)
 
-    # Perform crops
-    crops = crop_image_vertically(image, crop_height)
+    # Perform crops and adjust the bounding boxes for each of them
+    crops = crop_sample(image, widgets, crop_height, rng)
 
     base_name = image_path.stem
-    for i, (crop, offset_y, shift) in enumerate(crops):
+    outputs = []
+    for i, (crop, updated_widgets) in enumerate(crops):
         crop_name = f"{base_name}_crop_{i}.jpg"
         crop_path = img_out_dir / crop_name
         cv2.imwrite(str(crop_path), crop)
 
-        # Adjust the bounding boxes for this specific crop
-        updated_widgets = adjust_widget_bboxes(widgets, offset_y, crop_height)
-
         # Save updated JSON
         json_name = f"{base_name}_crop_{i}.json"
         json_path = json_out_dir / json_name
         with open(json_path, 'w') as f:
             json.dump(updated_widgets, f, indent=4)
 
+        outputs += [crop_path.relative_to(out_dir), json_path.relative_to(out_dir)]
+    return outputs
+
+def crop_images(jobs, out_dir, crop_height):
+    """
+    process_image for a chunk of (key, image_path, json_path) jobs. Every image
+    draws its crops from its own generator seeded with (key, SEED), so they do
+    not depend on the worker or the order the images are done in.
+    Returns (job, outputs) for each job.
+    """
+    return [((key, image_path, json_path),
+             process_image(image_path, json_path, out_dir, crop_height, random.Random(f'{key}|{SEED}')))
+            for key, image_path, json_path in jobs]
+
+def crop_encoded_samples(samples, crop_height):
+    """
+    Crops a chunk of (key, image, widgets) samples, the images being encoded
+    bytes or, from a raster set, arrays. The crops are encoded unless
+    OUTPUT_RASTERS is set, in which case they stay views of the input image.
+    Returns (key, crops) for each, crops being a list of (image, widgets), or
+    None if the image could not be decoded.
+    """
+    results = []
+    for key, image, widgets in samples:
+        if isinstance(image, bytes):
+            image = decode_image(image)
+        if image is None:
+            results.append((key, None))
+            continue
+        # seeded as for the same sample as files
+        rng = random.Random(f'{image_relpath(key)}|{SEED}')
+        results.append((key, [(crop if OUTPUT_RASTERS else encode_image(crop), updated_widgets)
+                              for crop, updated_widgets in crop_sample(image, widgets, crop_height, rng)]))
+    return results
+
+def map_chunks(function, items, *args):
+    """
+    Yields function(chunk, *args) for consecutive chunks of CHUNK_SIZE items, in
+    order. With NUM_WORKERS > 1 the chunks run on a pool of WORKER_TYPE workers,
+    at most 2 * NUM_WORKERS chunks at a time, so reading, cropping and writing of
+    different images overlap while only a bounded number of images is in memory.
+    """
+    items = iter(items)
+    chunks = iter(lambda: list(itertools.islice(items, CHUNK_SIZE)), [])
+    if NUM_WORKERS <= 1:
+        for chunk in chunks:
+            yield function(chunk, *args)
+        return
+
+    # the OpenCV codecs release the GIL, so threads are usually enough; forked
+    # processes inherit the configuration as the parent has it
+    if WORKER_TYPE == 'process':
+        executor = ProcessPoolExecutor(NUM_WORKERS, mp_context=multiprocessing.get_context('fork'))
+    else:
+        executor = ThreadPoolExecutor(NUM_WORKERS)
+    with executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(function, chunk, *args))
+            if len(pending) >= 2 * NUM_WORKERS:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def process_samples(src_dir, out_dir, crop_height):
+    """
+    Crops every sample of 'src_dir' (a raster set, a shard set or a directory)
+    into 'out_dir', as a raster set if OUTPUT_RASTERS is set, else as shards if
+    OUTPUT_SHARDS is set.
+    """
+    samples = read_rasters(src_dir) if is_raster_dir(src_dir) else read_samples(src_dir)
+    writer = RasterWriter(out_dir) if OUTPUT_RASTERS else SampleWriter(out_dir, shards=OUTPUT_SHARDS)
+    with writer:
+        idx = 0
+        for results in map_chunks(crop_encoded_samples, samples, crop_height):
+            for key, crops in results:
+                idx += 1
+                print(f'Processing {idx}: {key}')
+                if crops is None:
+                    print(f"Could not read image: {key}")
+                    continue
+                for i, (image, updated_widgets) in enumerate(crops):
+                    writer.write(f'{key}_crop_{i}', image, updated_widgets)
+
 # -----------------------------
 # Main Script
 # -----------------------------
 src_dir = Path('out_0_random_images')
 out_dir = Path('out_1_cropped_images')
 
-# Remove old outputs, create fresh directory
-shutil.rmtree(out_dir, ignore_errors=True)
-os.makedirs(out_dir, exist_ok=True)
-
 CROP_HEIGHT = 1024
 
-# Gather all images
-image_paths = list(src_dir.rglob('*.jpg'))
-image_paths = [i for i in image_paths if '/plot/' not in str(i)]
+# crop offsets of an image are drawn from a generator seeded with (image path, SEED)
+SEED = 0
 
-for idx, image_path in enumerate(image_paths):
-    print(f'Processing {idx + 1}/{len(image_paths)}: {image_path}')
-    
-    json_path = Path(str(image_path).replace('/image/', '/json/').replace('.jpg', '.json'))
-        
-    if json_path.exists():
-        process_image(image_path, json_path, out_dir, CROP_HEIGHT)
+# keep out_dir between runs and only re-crop the images that changed since the
+# last run (see stage_manifest.py); crops of removed images are deleted
+INCREMENTAL = True
+
+# images are cropped in chunks of CHUNK_SIZE by NUM_WORKERS workers, threads
+# or processes (WORKER_TYPE); outputs are the same for any of these settings
+NUM_WORKERS = 4
+WORKER_TYPE = 'thread'  # 'thread' or 'process'
+CHUNK_SIZE = 4
+
+# write the crops into tar shards (see sample_shards.py) instead of one file
+# each; src_dir is read as shards whenever it holds a shard set. Runs with
+# shards on either side always redo every image
+OUTPUT_SHARDS = False
+
+# write the crops undecoded into memory-mapped packs (see raw_raster.py) for
+# 2_augment_images.py, which then encodes each image once; src_dir is read as a
+# raster set whenever it holds one. Like shards, always redone from scratch
+OUTPUT_RASTERS = False
+
+if __name__ == '__main__':
+    sharded = OUTPUT_SHARDS or OUTPUT_RASTERS or is_shard_dir(src_dir) or is_raster_dir(src_dir)
+    manifest = open_manifest(out_dir, {
+        'code': get_file_digest(__file__),
+        'crop_height': CROP_HEIGHT,
+        'seed': SEED,
+    }, INCREMENTAL and not sharded)
+    if sharded:
+        process_samples(src_dir, out_dir, CROP_HEIGHT)
     else:
-        print(f"No JSON found for {image_path}")
+        # Gather all images
+        image_paths = list(src_dir.rglob('*.jpg'))
+        image_paths = [i for i in image_paths if '/plot/' not in str(i)]
+        manifest.prune(str(image_path.relative_to(src_dir)) for image_path in image_paths)
+
+        skipped = 0
+        jobs = []
+        for image_path in image_paths:
+            json_path = Path(str(image_path).replace('/image/', '/json/').replace('.jpg', '.json'))
+            key = str(image_path.relative_to(src_dir))
+            if manifest.is_current(key, [image_path, json_path]):
+                skipped += 1
+                continue
+            manifest.discard(key)
+
+            if json_path.exists():
+                jobs.append((key, image_path, json_path))
+            else:
+                print(f"No JSON found for {image_path}")
+
+        done = 0
+        for results in map_chunks(crop_images, jobs, out_dir, CROP_HEIGHT):
+            for (key, image_path, json_path), outputs in results:
+                done += 1
+                print(f'Processing {done}/{len(jobs)}: {image_path}')
+                if outputs:
+                    manifest.record(key, [image_path, json_path], outputs)
+
+        manifest.save()
+        print(f'{skipped}/{len(image_paths)} images up to date')
@@ -1,55 +1,86 @@
-import os, shutil
-import cv2
+import os
+import inspect
 import json
 import random
+import itertools
+from functools import partial
+import multiprocessing
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import albumentations as A
+from stage_manifest import get_file_digest, open_manifest
+from sample_shards import SampleWriter, decode_image, encode_image, image_relpath, is_shard_dir, read_samples
+from raw_raster import is_raster_dir, read_rasters
+from displacement_bank import BankedElasticTransform
+from transform_timing import TimingStats, TransformTimer, time_transforms
+from image_meta import IMAGE_KEY, with_image_size
 
 
-transforms = A.Compose([
-                A.HorizontalFlip(p=0.3),
-                A.Perspective(scale=(0.05, 0.1), p=0.3),
-                A.GridDistortion(num_steps=5, distort_limit=0.7, p=0.3),
-                A.ElasticTransform(alpha=8, sigma=5, alpha_affine=0, approximate=True, p=0.3),
-                A.GaussNoise(var_limit=(10.0, 50.0), p=0.3),
-                A.GaussianBlur(blur_limit=(8, 12), p=0.3),
-                A.RandomShadow(
-                    shadow_gray_value=(300, 500),
-                    p=0.3
-                ),
-                A.InvertImg(p=0.3),
-                A.ShiftScaleRotate(
-                    shift_limit=0.1,
-                    scale_limit=0.1,
-                    rotate_limit=3,
-                    p=0.3
-                ),
-                A.RandomBrightnessContrast(p=0.3),
-                A.RGBShift(r_shift_limit=50, g_shift_limit=50, b_shift_limit=50, p=0.3),
-                A.MotionBlur(blur_limit=(6,10), p=0.3)
-            ],
-bbox_params=A.BboxParams(format='pascal_voc',
-                         label_fields=['category_ids'],
-                         min_visibility=0.4)
-)
+def build_transforms(bank_dir=None, timer=None):
+    """
+    The augmentation pipeline. With 'bank_dir', ElasticTransform takes its
+    displacement fields from the banks there (see displacement_bank.py); with
+    'timer', every transform reports its calls to it (see transform_timing.py).
+    """
+    elastic_transform = A.ElasticTransform if bank_dir is None else partial(BankedElasticTransform, bank_dir=bank_dir)
+    compose = A.Compose([
+                    A.HorizontalFlip(p=0.3),
+                    A.Perspective(scale=(0.05, 0.1), p=0.3),
+                    A.GridDistortion(num_steps=5, distort_limit=0.7, p=0.3),
+                    elastic_transform(alpha=8, sigma=5, alpha_affine=0, approximate=True, p=0.3),
+                    A.GaussNoise(var_limit=(10.0, 50.0), p=0.3),
+                    A.GaussianBlur(blur_limit=(8, 12), p=0.3),
+                    A.RandomShadow(
+                        shadow_gray_value=(300, 500),
+                        p=0.3
+                    ),
+                    A.InvertImg(p=0.3),
+                    A.ShiftScaleRotate(
+                        shift_limit=0.1,
+                        scale_limit=0.1,
+                        rotate_limit=3,
+                        p=0.3
+                    ),
+                    A.RandomBrightnessContrast(p=0.3),
+                    A.RGBShift(r_shift_limit=50, g_shift_limit=50, b_shift_limit=50, p=0.3),
+                    A.MotionBlur(blur_limit=(6,10), p=0.3)
+                ],
+    bbox_params=A.BboxParams(format='pascal_voc',
+                             label_fields=['category_ids'],
+                             min_visibility=0.4)
+    )
+    return time_transforms(compose, timer) if timer is not None else compose
 
+transforms = build_transforms()
+transform_timer = None
+
+
+def seed_augmentation(seed):
+    """
+    Seeds the generators 'transforms' draws from: numpy's global one and, since
+    albumentations 1.4.22, the ones of its own. 'random' is left to the caller.
+    """
+    np.random.seed(seed % 2**32)
+    if hasattr(transforms, 'set_random_seed'):
+        transforms.set_random_seed(seed % 2**32)
 
 def augment_image(image, bboxes, category_ids):
     return transforms(image=image, bboxes=bboxes, category_ids=category_ids)
 
-def process_augmentation(image_path, json_path, out_img_path, out_json_path):
-    image = cv2.imread(str(image_path))
-    if image is None:
-        print(f"Could not load image: {image_path}")
-        return
-    
-    with open(json_path, 'r') as f:
-        annotations = json.load(f)
-    
+def augment_sample(image, annotations, p=0.5):
+    """
+    Augments the image with probability p and moves the annotation bboxes with it.
+    Annotations whose bbox does not survive the augmentation are dropped; an
+    image size stored in them (see image_meta.py) is updated.
+    Returns (augmented_image, updated_annotations).
+    """
     # original_data will hold each annotation's key and its bounding box
     # We'll assign a unique numeric ID to each bounding box for label matching
     original_data = []
-    for i, (key, value) in enumerate(annotations.items()):
+    widget_items = [(key, value) for key, value in annotations.items() if key != IMAGE_KEY]
+    for i, (key, value) in enumerate(widget_items):
         bbox = value['bbox']
         original_data.append({
             'id': i,             # Unique bounding box ID
@@ -62,7 +93,7 @@ def process_augmentation(image_path, json_path, out_img_path, out_json_path):
     category_ids = [item['id'] for item in original_data]  # use numeric IDs
     
     # Randomly apply augmentation
-    if random.random() < 0.5:  # 50% probability
+    if random.random() < p:  # 50% probability by default
         augmented = augment_image(image, bboxes, category_ids)
         aug_image = augmented['image']
         aug_bboxes = augmented['bboxes']
@@ -79,7 +110,7 @@ def process_augmentation(image_path, json_path, out_img_path, out_json_path):
         orig_item = original_data[bbox_id]
         
         # Create or update the annotation
-        updated_annotations[orig_item['key']] = annotations[orig_item['key']]
+        updated_annotations[orig_item['key']] = dict(annotations[orig_item['key']])
         # Overwrite with the new bounding box
         updated_annotations[orig_item['key']]['bbox'] = {
             'xmin': int(bbox[0]),
@@ -87,45 +118,253 @@ def process_augmentation(image_path, json_path, out_img_path, out_json_path):
             'xmax': int(bbox[2]),
             'ymax': int(bbox[3])
         }
-    
-    cv2.imwrite(str(out_img_path), aug_image)
-    with open(out_json_path, 'w') as f:
-        json.dump(updated_annotations, f, indent=4)
+
+    if IMAGE_KEY in annotations:
+        updated_annotations = with_image_size(updated_annotations, aug_image)
+    return aug_image, updated_annotations
+
+def get_variant_suffixes():
+    """Name suffixes of the outputs of one image, the clean copy's first."""
+    if NUM_VARIANTS == 1 and not INCLUDE_CLEAN_COPY:
+        return ['']
+    return ['_clean'] * INCLUDE_CLEAN_COPY + [f'_aug_{v}' for v in range(NUM_VARIANTS)]
+
+def augment_encoded(image_key, image, annotations, image_bytes=None):
+    """
+    Makes the NUM_VARIANTS augmented variants of one decoded image (and its
+    clean copy with INCLUDE_CLEAN_COPY). Variant v is seeded with (image_key, v,
+    SEED), image_key being the image's path relative to the input directory, so
+    the result does not depend on the process or the order it is augmented in;
+    variant 0 is seeded as the single output of NUM_VARIANTS = 1. The clean copy
+    is 'image_bytes', the encoded input, when given.
+    Returns (suffix, jpeg_bytes, updated_annotations) for each variant that
+    could be made, none if the image could not be read.
+    """
+    if image is None:
+        print(f"Could not load image: {image_key}")
+        return []
+
+    variants = []
+    suffixes = get_variant_suffixes()
+    if INCLUDE_CLEAN_COPY:
+        variants.append((suffixes.pop(0), image_bytes or encode_image(image), annotations))
+    for v, suffix in enumerate(suffixes):
+        random.seed(f'{image_key}|{SEED}' if v == 0 else f'{image_key}|{v}|{SEED}')
+        seed_augmentation(random.getrandbits(32))
+        if transform_timer is not None:
+            transform_timer.start_image()
+        try:
+            # with a clean copy next to them, every variant is augmented
+            aug_image, updated_annotations = augment_sample(image, annotations, p=1.0 if INCLUDE_CLEAN_COPY else 0.5)
+        except Exception as e:
+            print(e)
+            continue
+        variants.append((suffix, encode_image(aug_image), updated_annotations))
+    return variants
+
+def augment_files(jobs):
+    """augment_encoded for a chunk of (key, image_path, json_path) jobs; returns (job, variants) for each."""
+    results = []
+    for key, image_path, json_path in jobs:
+        with open(json_path, 'r') as f:
+            annotations = json.load(f)
+        image_bytes = image_path.read_bytes()
+        results.append(((key, image_path, json_path),
+                        augment_encoded(key, decode_image(image_bytes), annotations, image_bytes)))
+    return results
+
+def augment_samples(samples):
+    """
+    augment_encoded for a chunk of (key, image, annotations) samples, the images
+    encoded bytes or arrays; returns (key, variants) for each.
+    """
+    results = []
+    for key, image, annotations in samples:
+        image_bytes = image if isinstance(image, bytes) else None
+        if image_bytes is not None:
+            image = decode_image(image_bytes)
+        results.append((key, augment_encoded(image_relpath(key), image, annotations, image_bytes)))
+    return results
+
+def init_worker():
+    """
+    Builds 'transforms' as configured; every worker augments with a Compose
+    (and times it with a TransformTimer) of its own.
+    """
+    global transforms, transform_timer
+    if TIME_TRANSFORMS or TIME_BUDGET_MS is not None:
+        transform_timer = TransformTimer(TIME_BUDGET_MS)
+    transforms = build_transforms(DISPLACEMENT_BANK_DIR if USE_DISPLACEMENT_BANK else None, transform_timer)
+
+def run_chunk(function, chunk):
+    """function(chunk), with the transform calls timed while running it."""
+    results = function(chunk)
+    return results, transform_timer.drain() if transform_timer is not None else []
+
+def build_displacement_banks():
+    """Draws the banks of the banked transforms for DISPLACEMENT_BANK_SHAPES, unless they exist."""
+    for transform in transforms.transforms:
+        if hasattr(transform, 'build_bank'):
+            for shape in DISPLACEMENT_BANK_SHAPES:
+                print(f'building displacement bank {transform.get_bank_path(shape)}')
+                transform.build_bank(shape, DISPLACEMENT_FIELDS, SEED)
+
+def map_chunks(function, items):
+    """
+    Yields run_chunk(function, chunk) for consecutive chunks of CHUNK_SIZE items, in order.
+    With NUM_WORKERS > 1 the chunks run on a process pool, at most
+    2 * NUM_WORKERS chunks at a time, so the results waiting to be written are
+    bounded and are written in the same order whatever the worker count.
+    """
+    items = iter(items)
+    chunks = iter(lambda: list(itertools.islice(items, CHUNK_SIZE)), [])
+    if NUM_WORKERS <= 1:
+        for chunk in chunks:
+            yield run_chunk(function, chunk)
+        return
+
+    # processes, since the generators the augmentations draw from are global;
+    # forked, so init_worker sees the configuration as the parent has it
+    with ProcessPoolExecutor(NUM_WORKERS, mp_context=multiprocessing.get_context('fork'),
+                             initializer=init_worker) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(run_chunk, function, chunk))
+            if len(pending) >= 2 * NUM_WORKERS:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def process_samples(cropped_dir, out_dir, timing_stats):
+    """
+    Augments every sample of 'cropped_dir' (a raster set, a shard set or a
+    directory) into 'out_dir', as shards if OUTPUT_SHARDS is set. Images of a
+    raster set are augmented straight from the mapped packs.
+    """
+    samples = read_rasters(cropped_dir) if is_raster_dir(cropped_dir) else read_samples(cropped_dir)
+    with SampleWriter(out_dir, shards=OUTPUT_SHARDS) as writer:
+        idx = 0
+        for results, calls in map_chunks(augment_samples, samples):
+            timing_stats.add(calls)
+            for key, variants in results:
+                idx += 1
+                print(f'augmenting {idx}', end='\r')
+                for suffix, image_bytes, updated_annotations in variants:
+                    writer.write(f'{key}{suffix}', image_bytes, updated_annotations)
 
 # ------------------ Main Execution ------------------
 cropped_dir = Path('out_1_cropped_images')
 out_dir = Path('out_2_augmented_images')
-shutil.rmtree(out_dir, ignore_errors=True)
-os.makedirs(out_dir)
 
-image_paths = list(cropped_dir.rglob('*.jpg'))
-for idx, image_path in enumerate(image_paths):
-    print(f'augmenting {idx+1}/{len(image_paths)}', end='\r')
-    
-    # Infer JSON path
-    json_path = Path(str(image_path).replace('/image/', '/json/').replace('.jpg', '.json'))
-    if not json_path.exists():
-        print(f"JSON file does not exist for {image_path}. Skipping...")
-        continue
-
-    # Create output directories
-    img_name = image_path.name
-    rel_img_path = image_path.relative_to(cropped_dir).parent
-    img_out_dir = out_dir / rel_img_path
-    os.makedirs(img_out_dir, exist_ok=True)
-    out_img_path = img_out_dir / img_name
-
-    json_name = json_path.name
-    rel_json_path = json_path.relative_to(cropped_dir).parent
-    json_out_dir = out_dir / rel_json_path
-    os.makedirs(json_out_dir, exist_ok=True)
-    out_json_path = json_out_dir / json_name
-
-    try:
-        process_augmentation(image_path, json_path, out_img_path, out_json_path)
-    except Exception as e:
-        if os.path.exists(out_img_path):
-            os.unlink(out_img_path)
-        if os.path.exists(out_json_path):
-            os.unlink(out_json_path)
-        print(e)
\ No newline at end of file
+# augmentations of an image are drawn from generators seeded with (image path, SEED)
+SEED = 0
+
+# images are augmented in chunks of CHUNK_SIZE by NUM_WORKERS processes and
+# written by the main one; outputs are the same for any worker count
+NUM_WORKERS = 4
+CHUNK_SIZE = 4
+
+# write NUM_VARIANTS augmented variants of every image, named <stem>_aug_<v>,
+# from a single decode of it; with INCLUDE_CLEAN_COPY also the image itself as
+# <stem>_clean, and every variant is augmented instead of half of them. With
+# one variant and no clean copy, outputs keep the input names
+NUM_VARIANTS = 1
+INCLUDE_CLEAN_COPY = False
+
+# take the ElasticTransform displacement fields (a Gaussian blur of two
+# full-size noise fields per image, the most expensive step here) from banks of
+# DISPLACEMENT_FIELDS fields per image shape, drawn once into DISPLACEMENT_BANK_DIR
+# (see displacement_bank.py). Crops of other shapes get fresh fields
+USE_DISPLACEMENT_BANK = False
+DISPLACEMENT_BANK_DIR = Path('out_displacement_bank')
+DISPLACEMENT_FIELDS = 256
+DISPLACEMENT_BANK_SHAPES = [(1024, 2048)]
+
+# time every transform call (see transform_timing.py): the calls are logged to
+# TIMING_LOG_PATH and, at the end, summed up per transform and image shape in a
+# table that is printed and written to TIMING_TABLE_PATH. With TIME_BUDGET_MS,
+# a transform that would take an image past that many milliseconds (by its mean
+# time so far) is skipped; outputs then depend on timing
+TIME_TRANSFORMS = False
+TIMING_LOG_PATH = Path('out_2_augment_timings.csv')
+TIMING_TABLE_PATH = Path('out_2_augment_timings.txt')
+TIME_BUDGET_MS = None
+
+# keep out_dir between runs and only re-augment the images that changed since
+# the last run (see stage_manifest.py); outputs of removed images are deleted
+INCREMENTAL = True
+
+# write the augmented images into tar shards (see sample_shards.py) instead of
+# one file each; cropped_dir is read as shards, or as a raster set (see
+# raw_raster.py), whenever it holds one. Runs with shards or rasters on either
+# side always redo every image
+OUTPUT_SHARDS = False
+
+if __name__ == '__main__':
+    sharded = OUTPUT_SHARDS or is_shard_dir(cropped_dir) or is_raster_dir(cropped_dir)
+    manifest = open_manifest(out_dir, {
+        'code': get_file_digest(__file__),
+        'seed': SEED,
+        'variants': [NUM_VARIANTS, INCLUDE_CLEAN_COPY],
+        'displacement_bank': [get_file_digest(inspect.getfile(BankedElasticTransform)), DISPLACEMENT_FIELDS,
+                              DISPLACEMENT_BANK_SHAPES] if USE_DISPLACEMENT_BANK else None,
+        'time_budget_ms': TIME_BUDGET_MS,
+    }, INCREMENTAL and not sharded)
+    init_worker()
+    if USE_DISPLACEMENT_BANK:
+        build_displacement_banks()
+    timing_stats = TimingStats(TIMING_LOG_PATH if transform_timer is not None else None)
+
+    if sharded:
+        process_samples(cropped_dir, out_dir, timing_stats)
+    else:
+        image_paths = list(cropped_dir.rglob('*.jpg'))
+        manifest.prune(str(image_path.relative_to(cropped_dir)) for image_path in image_paths)
+
+        skipped = 0
+        jobs = []
+        for image_path in image_paths:
+            # Infer JSON path
+            json_path = Path(str(image_path).replace('/image/', '/json/').replace('.jpg', '.json'))
+            if not json_path.exists():
+                print(f"JSON file does not exist for {image_path}. Skipping...")
+                continue
+
+            key = str(image_path.relative_to(cropped_dir))
+            if manifest.is_current(key, [image_path, json_path]):
+                skipped += 1
+                continue
+            manifest.discard(key)
+            jobs.append((key, image_path, json_path))
+
+        done = 0
+        for results, calls in map_chunks(augment_files, jobs):
+            timing_stats.add(calls)
+            for (key, image_path, json_path), variants in results:
+                done += 1
+                print(f'augmenting {done}/{len(jobs)}', end='\r')
+
+                # failed augmentations are recorded without outputs, so they are not
+                # retried until the image changes
+                outputs = []
+                img_out_dir = out_dir / image_path.relative_to(cropped_dir).parent
+                json_out_dir = out_dir / json_path.relative_to(cropped_dir).parent
+                os.makedirs(img_out_dir, exist_ok=True)
+                os.makedirs(json_out_dir, exist_ok=True)
+                for suffix, image_bytes, updated_annotations in variants:
+                    out_img_path = img_out_dir / f'{image_path.stem}{suffix}.jpg'
+                    out_json_path = json_out_dir / f'{json_path.stem}{suffix}.json'
+                    out_img_path.write_bytes(image_bytes)
+                    with open(out_json_path, 'w') as f:
+                        json.dump(updated_annotations, f, indent=4)
+                    outputs += [out_img_path.relative_to(out_dir), out_json_path.relative_to(out_dir)]
+                manifest.record(key, [image_path, json_path], outputs)
+
+        manifest.save()
+        print(f'{skipped}/{len(image_paths)} images up to date')
+
+    timing_stats.close()
+    if transform_timer is not None:
+        table = timing_stats.table()
+        print(table)
+        TIMING_TABLE_PATH.write_text(table + '\n')
\ No newline at end of file
@@ -1,7 +1,10 @@
 import os
 import json
 import shutil
-import cv2
+from stage_manifest import get_file_digest, open_manifest
+from sample_shards import ShardReader, is_shard_dir
+from image_store import ImageStore
+from image_meta import CACHE_NAME, IMAGE_KEY, ImageSizeCache, get_stored_image_size, probe_image_size
 
 # Define class mappings
 class_mapping = {
@@ -31,29 +34,15 @@ def convert_to_coco(xmin, ymin, xmax, ymax):
     height = ymax - ymin
     return [xmin, ymin, width, height], width * height
 
-def process_coco_annotation(doc_type, json_path, img_name, img_path,
-                            annotations, images,
-                            image_id, annotation_id,
-                            img_width, img_height,
-                            output_dir):
+def get_coco_annotations(widgets, image_id, annotation_id):
     """
-    Reads the JSON, appends image + annotation entries to the COCO structures,
-    and copies the image to 'output_dir/images' with a doc_type prefix.
+    Builds the COCO annotation entries of one image's widgets,
+    numbered from 'annotation_id'.
     """
-    with open(json_path, "r") as f:
-        widgets = json.load(f)
-
-    # Add image metadata
-    prefixed_name = f"{doc_type}_{img_name}"
-    images.append({
-        "id": image_id,
-        "file_name": prefixed_name,
-        "width": img_width,
-        "height": img_height
-    })
-
-    # Process annotations
+    annotations = []
     for widget_name, widget_dict in widgets.items():
+        if widget_name == IMAGE_KEY:
+            continue
         class_id = get_class_id(widget_dict)
         if class_id is None:
             continue
@@ -71,12 +60,58 @@ def process_coco_annotation(doc_type, json_path, img_name, img_path,
             "iscrowd": 0
         })
         annotation_id += 1
+    return annotations
+
+def write_coco_annotations(images, annotations, output_dir):
+    coco_output = {
+        "images": images,
+        "annotations": annotations,
+        "categories": [
+            {"id": 0, "name": "checkbox_unchecked"},
+            {"id": 1, "name": "checkbox_checked"},
+            {"id": 2, "name": "textfield"},
+            {"id": 3, "name": "signature"}
+        ]
+    }
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, "annotations.json"), "w") as f:
+        json.dump(coco_output, f, indent=4)
+
+def process_coco_annotation(doc_type, json_path, img_name, img_path,
+                            annotations, images,
+                            image_id, annotation_id,
+                            img_width, img_height,
+                            output_dir, image_store=None):
+    """
+    Reads the JSON, appends image + annotation entries to the COCO structures,
+    and copies the image to 'output_dir/images' with a doc_type prefix (links
+    it, with an ImageStore).
+    """
+    with open(json_path, "r") as f:
+        widgets = json.load(f)
+
+    # Add image metadata
+    prefixed_name = f"{doc_type}_{img_name}"
+    images.append({
+        "id": image_id,
+        "file_name": prefixed_name,
+        "width": img_width,
+        "height": img_height
+    })
+
+    # Process annotations
+    image_annotations = get_coco_annotations(widgets, image_id, annotation_id)
+    annotations.extend(image_annotations)
+    annotation_id += len(image_annotations)
 
     # Copy image to output directory with prefixed name
     coco_image_dir = os.path.join(output_dir, "images")
     os.makedirs(coco_image_dir, exist_ok=True)
     dest_image_path = os.path.join(coco_image_dir, prefixed_name)
-    shutil.copy(img_path, dest_image_path)
+    if image_store is not None:
+        image_store.export_file(img_path, dest_image_path)
+    else:
+        shutil.copy(img_path, dest_image_path)
 
     return annotation_id
 
@@ -84,24 +119,37 @@ def traverse_and_convert_coco(root_dir, output_dir):
     """
     Traverses 'root_dir' looking for JSON files and matching images,
     creates COCO-style annotations, and writes them to 'output_dir'.
+    Images whose JSON and image did not change since the last run keep their
+    copy and reuse the entries kept in the manifest; annotations.json is
+    rebuilt from all of them.
     """
+    manifest = open_manifest(output_dir, {
+        'code': get_file_digest(__file__),
+        'classes': class_mapping,
+    }, INCREMENTAL)
+    image_sizes = ImageSizeCache(os.path.join(output_dir, CACHE_NAME))
+    image_store = ImageStore(IMAGE_STORE_DIR, file_digest=manifest.file_digest) if IMAGE_STORE_DIR else None
+
     annotations = []
     images = []
     annotation_id = 1
     image_id = 1
 
-    # Collect all JSON file paths
+    # Collect all JSON file paths, sorted so ids do not change between runs
     json_files = []
     for dirpath, _, filenames in os.walk(root_dir):
         for file in filenames:
             if file.endswith(".json"):
                 json_path = os.path.join(dirpath, file)
                 json_files.append(json_path)
+    json_files.sort()
+    manifest.prune(os.path.relpath(json_path, root_dir) for json_path in json_files)
 
     total_files = len(json_files)
     print(f"Found {total_files} JSON files to process.")
 
     processed_count = 0
+    skipped_count = 0
     for json_path in json_files:
         parts = json_path.split(os.sep)
         doc_type = parts[-3]
@@ -113,46 +161,123 @@ def traverse_and_convert_coco(root_dir, output_dir):
             print(f"Warning: Image not found for JSON: {json_path}")
             continue
 
-        # Read image to get actual width/height
-        img = cv2.imread(img_path)
-        if img is None:
-            print(f"Error: Could not open image: {img_path}")
-            continue
+        key = os.path.relpath(json_path, root_dir)
+        if manifest.is_current(key, [json_path, img_path]):
+            skipped_count += 1
+        else:
+            manifest.discard(key)
 
-        img_height, img_width = img.shape[:2]
+            # Image width/height, stored in the JSON by an earlier stage or
+            # read from the image header
+            with open(json_path, "r") as f:
+                img_size = get_stored_image_size(json.load(f)) or image_sizes.get(img_path)
+            if img_size is None:
+                print(f"Error: Could not open image: {img_path}")
+                continue
 
-        # Process COCO annotation
-        annotation_id = process_coco_annotation(
-            doc_type, json_path, img_name, img_path,
-            annotations, images,
-            image_id, annotation_id,
-            img_width, img_height,
-            output_dir
-        )
-        image_id += 1
+            img_width, img_height = img_size
+
+            # Process COCO annotation; ids are assigned below, over all images
+            entry_annotations, entry_images = [], []
+            process_coco_annotation(
+                doc_type, json_path, img_name, img_path,
+                entry_annotations, entry_images,
+                0, 0,
+                img_width, img_height,
+                output_dir, image_store
+            )
+            manifest.record(key, [json_path, img_path],
+                            [os.path.join("images", entry_images[0]["file_name"])],
+                            data={"image": entry_images[0], "annotations": entry_annotations})
+
+            processed_count += 1
+            print(f"Processed {processed_count}/{total_files}")
 
-        processed_count += 1
-        print(f"Processed {processed_count}/{total_files}")
+        entry = manifest.data(key)
+        images.append(dict(entry["image"], id=image_id))
+        for annotation in entry["annotations"]:
+            annotations.append(dict(annotation, id=annotation_id, image_id=image_id))
+            annotation_id += 1
+        image_id += 1
 
     # Save COCO JSON file
-    coco_output = {
-        "images": images,
-        "annotations": annotations,
-        "categories": [
-            {"id": 0, "name": "checkbox_unchecked"},
-            {"id": 1, "name": "checkbox_checked"},
-            {"id": 2, "name": "textfield"},
-            {"id": 3, "name": "signature"}
-        ]
-    }
-    os.makedirs(output_dir, exist_ok=True)
-    with open(os.path.join(output_dir, "annotations.json"), "w") as f:
-        json.dump(coco_output, f, indent=4)
+    write_coco_annotations(images, annotations, output_dir)
+    manifest.save()
+    image_sizes.save()
+    print(f"{skipped_count}/{total_files} images up to date")
+    if image_store is not None:
+        image_store.prune()
+        print(image_store.summary())
 
     print("COCO conversion and image copying complete.")
 
+def convert_shards_coco(root_dir, output_dir):
+    """
+    Same as traverse_and_convert_coco for a shard set at 'root_dir': the images
+    are written out of the shards under their prefixed names. Always converts
+    everything.
+    """
+    shutil.rmtree(output_dir, ignore_errors=True)
+    coco_image_dir = os.path.join(output_dir, "images")
+    os.makedirs(coco_image_dir)
+
+    image_store = ImageStore(IMAGE_STORE_DIR) if IMAGE_STORE_DIR else None
+
+    annotations = []
+    images = []
+    reader = ShardReader(root_dir)
+    print(f"Found {len(reader)} samples to process.")
+
+    # sorted, so ids follow the same order as for a directory
+    for key in sorted(reader.keys()):
+        image_bytes, widgets = reader.read(key)
+        img_size = get_stored_image_size(widgets) or probe_image_size(image_bytes)
+        if img_size is None:
+            print(f"Error: Could not decode image: {key}")
+            continue
+        img_width, img_height = img_size
+
+        doc_type, stem = key.rsplit("/", 1)
+        prefixed_name = f"{doc_type}_{stem}.jpg"
+        image_id = len(images) + 1
+        images.append({
+            "id": image_id,
+            "file_name": prefixed_name,
+            "width": img_width,
+            "height": img_height
+        })
+        annotations.extend(get_coco_annotations(widgets, image_id, len(annotations) + 1))
+        dest_image_path = os.path.join(coco_image_dir, prefixed_name)
+        if image_store is not None:
+            image_store.export_bytes(image_bytes, dest_image_path)
+        else:
+            with open(dest_image_path, "wb") as f:
+                f.write(image_bytes)
+
+        print(f"Processed {image_id}/{len(reader)}")
+    reader.close()
+    if image_store is not None:
+        image_store.prune()
+        print(image_store.summary())
+
+    write_coco_annotations(images, annotations, output_dir)
+    print("COCO conversion complete.")
+
 # Configuration
 root_dir = "out_2_augmented_images"  # Root directory containing doc-type folders, images, and JSON
 output_dir = "out_3.1_converted_coco"  # Where COCO annotations + prefixed images will go
 
-traverse_and_convert_coco(root_dir, output_dir)
+# keep output_dir between runs and only convert the images that changed since
+# the last run (see stage_manifest.py); copies of removed images are deleted
+INCREMENTAL = True
+
+# export images as links to one content-addressed store shared by the export
+# stages (see image_store.py) instead of copying them; None copies
+IMAGE_STORE_DIR = "out_image_store"
+
+if __name__ == '__main__':
+    # root_dir may hold the previous stage's output as shards (see sample_shards.py)
+    if is_shard_dir(root_dir):
+        convert_shards_coco(root_dir, output_dir)
+    else:
+        traverse_and_convert_coco(root_dir, output_dir)
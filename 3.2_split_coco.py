@@ -2,15 +2,24 @@ import os
 import json
 import shutil
 import random
+from stage_manifest import get_file_digest, open_manifest
+from image_store import ImageStore
 
 # Configuration
 coco_dir = "out_3.1_converted_coco"  # Directory containing COCO images and annotations
 output_dir = "out_3.2_split_coco"  # Directory to save the split datasets
-shutil.rmtree(output_dir, ignore_errors=True)  # Clear previous output
-os.makedirs(output_dir)  # Create output directory
 
 train_ratio = 0.9  # Ratio for train split
 
+# keep output_dir between runs (see stage_manifest.py): images keep the split
+# they were put in, only new images are shuffled into train/val, only changed
+# images are copied again and copies of removed images are deleted
+INCREMENTAL = True
+
+# export images as links to one content-addressed store shared by the export
+# stages (see image_store.py) instead of copying them; None copies
+IMAGE_STORE_DIR = "out_image_store"
+
 # Create split directories
 def create_split_dirs():
     for split in ['train', 'val']:
@@ -30,18 +39,34 @@ def filter_annotations(images, all_annotations):
     return [ann for ann in all_annotations if ann["image_id"] in image_ids]
 
 # Split and move COCO files
-def split_coco_files():
+def split_coco_files(manifest):
     print("Splitting COCO files...")
     image_dir = os.path.join(coco_dir, "images")
     annotation_path = os.path.join(coco_dir, "annotations.json")
 
     with open(annotation_path, "r") as f:
         data = json.load(f)
+    manifest.prune(image_info["file_name"] for image_info in data["images"])
+    create_split_dirs()
+    image_store = ImageStore(IMAGE_STORE_DIR, file_digest=manifest.file_digest) if IMAGE_STORE_DIR else None
 
-    # Split images into train and validation sets
-    train_images, val_images = split_files(data["images"])
+    # Images split in an earlier run stay where they are; new ones are split
+    # into train and validation sets
+    image_splits = {}
+    new_images = []
+    for image_info in data["images"]:
+        split = manifest.data(image_info["file_name"])
+        if split is None:
+            new_images.append(image_info)
+        else:
+            image_splits[image_info["file_name"]] = split
+    for split, images in zip(['train', 'val'], split_files(new_images)):
+        for image_info in images:
+            image_splits[image_info["file_name"]] = split
+
+    for split in ['train', 'val']:
+        images = [image_info for image_info in data["images"] if image_splits[image_info["file_name"]] == split]
 
-    for split, images in zip(['train', 'val'], [train_images, val_images]):
         # Create split annotations
         split_annotations = {
             "images": images,
@@ -55,15 +80,29 @@ def split_coco_files():
         with open(split_annotation_path, "w") as f:
             json.dump(split_annotations, f, indent=4)
 
-        # Copy images to respective directories
+        # Copy new and changed images to respective directories
         for image_info in images:
             img_name = image_info["file_name"]
             img_src = os.path.join(image_dir, img_name)
+            if manifest.is_current(img_name, [img_src]):
+                continue
+            manifest.discard(img_name)
             img_dest = os.path.join(output_dir, "images", split, img_name)
-            shutil.copy(img_src, img_dest)
+            if image_store is not None:
+                image_store.export_file(img_src, img_dest)
+            else:
+                shutil.copy(img_src, img_dest)
+            manifest.record(img_name, [img_src], [os.path.relpath(img_dest, output_dir)], data=split)
 
+    manifest.save()
+    if image_store is not None:
+        image_store.prune()
+        print(image_store.summary())
     print("COCO dataset splitting complete.")
 
 # Run the script
-create_split_dirs()
-split_coco_files()
+manifest = open_manifest(output_dir, {
+    'code': get_file_digest(__file__),
+    'train_ratio': train_ratio,
+}, INCREMENTAL)
+split_coco_files(manifest)
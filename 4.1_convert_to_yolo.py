@@ -1,7 +1,11 @@
 import os
 import json
 import shutil
-import cv2  # <-- For reading image dimensions
+from stage_manifest import get_file_digest, open_manifest
+from sample_shards import is_shard_dir, read_samples
+from image_store import ImageStore
+from image_meta import (CACHE_NAME, IMAGE_KEY, ImageSizeCache, get_stored_image_size, probe_image_file,
+                        probe_image_size)
 
 # Define class mappings
 class_mapping = {
@@ -33,28 +37,12 @@ def convert_to_yolo(xmin, ymin, xmax, ymax, img_width, img_height):
     height = (ymax - ymin) / img_height
     return x_center, y_center, width, height
 
-def process_yolo_annotation(
-    doc_type,
-    json_path,
-    img_name,
-    img_path,
-    output_dir
-):
-    """Reads the JSON, converts bboxes to YOLO format, 
-    and writes .txt + image with doc_type prefix."""
-    # Read image dimensions dynamically
-    img = cv2.imread(img_path)
-    if img is None:
-        print(f"Error reading image {img_path}. Skipping...")
-        return
-    img_height, img_width = img.shape[:2]
-
-    # Load JSON
-    with open(json_path, "r") as f:
-        widgets = json.load(f)
-
+def get_yolo_lines(widgets, img_width, img_height):
+    """Converts one image's widget bboxes to YOLO label lines."""
     yolo_lines = []
     for widget_name, widget_dict in widgets.items():
+        if widget_name == IMAGE_KEY:
+            continue
         class_id = get_class_id(widget_dict)
         if class_id is None:
             continue
@@ -66,6 +54,36 @@ def process_yolo_annotation(
         x_center, y_center, width, height = convert_to_yolo(xmin, ymin, xmax, ymax, img_width, img_height)
         yolo_line = f"{class_id} {x_center} {y_center} {width} {height}\n"
         yolo_lines.append(yolo_line)
+    return yolo_lines
+
+def process_yolo_annotation(
+    doc_type,
+    json_path,
+    img_name,
+    img_path,
+    output_dir,
+    image_sizes=None,
+    image_store=None
+):
+    """Reads the JSON, converts bboxes to YOLO format, 
+    and writes .txt + image with doc_type prefix (the image linked through
+    image_store, an ImageStore, if given).
+    Returns the written files, relative to output_dir."""
+    # Load JSON
+    with open(json_path, "r") as f:
+        widgets = json.load(f)
+
+    # Image dimensions, stored in the JSON by an earlier stage or read from
+    # the image header (through image_sizes, an ImageSizeCache, if given)
+    img_size = get_stored_image_size(widgets)
+    if img_size is None:
+        img_size = image_sizes.get(img_path) if image_sizes is not None else probe_image_file(img_path)
+    if img_size is None:
+        print(f"Error reading image {img_path}. Skipping...")
+        return []
+    img_width, img_height = img_size
+
+    yolo_lines = get_yolo_lines(widgets, img_width, img_height)
 
     # Add document type prefix to file names
     # e.g. "invoice_<filename>.jpg"
@@ -84,11 +102,24 @@ def process_yolo_annotation(
 
     # Copy image to the YOLO output directory with prefixed name
     dest_image_path = os.path.join(yolo_image_dir, f"{prefixed_name}.jpg")
-    shutil.copy(img_path, dest_image_path)
+    if image_store is not None:
+        image_store.export_file(img_path, dest_image_path)
+    else:
+        shutil.copy(img_path, dest_image_path)
+
+    return [os.path.relpath(yolo_output_path, output_dir), os.path.relpath(dest_image_path, output_dir)]
 
 def traverse_and_convert_yolo(root_dir, output_dir):
     """Traverses root_dir looking for JSON files, 
-    finds corresponding images, and converts bounding boxes to YOLO."""
+    finds corresponding images, and converts bounding boxes to YOLO.
+    Images whose JSON and image did not change since the last run are skipped."""
+    manifest = open_manifest(output_dir, {
+        'code': get_file_digest(__file__),
+        'classes': class_mapping,
+    }, INCREMENTAL)
+    image_sizes = ImageSizeCache(os.path.join(output_dir, CACHE_NAME))
+    image_store = ImageStore(IMAGE_STORE_DIR, file_digest=manifest.file_digest) if IMAGE_STORE_DIR else None
+
     # Collect all JSON file paths
     json_files = []
     for dirpath, _, filenames in os.walk(root_dir):
@@ -96,11 +127,13 @@ def traverse_and_convert_yolo(root_dir, output_dir):
             if file.endswith(".json"):
                 json_path = os.path.join(dirpath, file)
                 json_files.append(json_path)
+    manifest.prune(os.path.relpath(json_path, root_dir) for json_path in json_files)
 
     total_files = len(json_files)
     print(f"Found {total_files} JSON files to process.")
 
     processed_count = 0
+    skipped_count = 0
     for json_path in json_files:
         parts = json_path.split(os.sep)
         # e.g. augmented_images/<doc_type>/json/file.json
@@ -115,19 +148,76 @@ def traverse_and_convert_yolo(root_dir, output_dir):
             print(f"Image file not found for {json_path}. Skipping...")
             continue
 
-        process_yolo_annotation(doc_type, json_path, img_name, img_path, output_dir)
+        key = os.path.relpath(json_path, root_dir)
+        if manifest.is_current(key, [json_path, img_path]):
+            skipped_count += 1
+            continue
+        manifest.discard(key)
+
+        outputs = process_yolo_annotation(doc_type, json_path, img_name, img_path, output_dir, image_sizes,
+                                          image_store)
+        if outputs:
+            manifest.record(key, [json_path, img_path], outputs)
 
         processed_count += 1
         print(f"Processed {processed_count}/{total_files}")
 
+    manifest.save()
+    image_sizes.save()
+    print(f"{skipped_count}/{total_files} images up to date")
+    if image_store is not None:
+        image_store.prune()
+        print(image_store.summary())
+
+def convert_shards_yolo(root_dir, output_dir):
+    """Same as traverse_and_convert_yolo for a shard set at root_dir: the
+    images are written out of the shards. Always converts everything."""
+    shutil.rmtree(output_dir, ignore_errors=True)
+    yolo_annot_dir = os.path.join(output_dir, "labels")
+    yolo_image_dir = os.path.join(output_dir, "images")
+    os.makedirs(yolo_annot_dir)
+    os.makedirs(yolo_image_dir)
+    image_store = ImageStore(IMAGE_STORE_DIR) if IMAGE_STORE_DIR else None
+
+    for idx, (key, image_bytes, widgets) in enumerate(read_samples(root_dir)):
+        img_size = get_stored_image_size(widgets) or probe_image_size(image_bytes)
+        if img_size is None:
+            print(f"Error decoding image {key}. Skipping...")
+            continue
+        img_width, img_height = img_size
+
+        doc_type, stem = key.rsplit("/", 1)
+        prefixed_name = f"{doc_type}_{stem}"
+        with open(os.path.join(yolo_annot_dir, f"{prefixed_name}.txt"), "w") as f:
+            f.writelines(get_yolo_lines(widgets, img_width, img_height))
+        dest_image_path = os.path.join(yolo_image_dir, f"{prefixed_name}.jpg")
+        if image_store is not None:
+            image_store.export_bytes(image_bytes, dest_image_path)
+        else:
+            with open(dest_image_path, "wb") as f:
+                f.write(image_bytes)
+
+        print(f"Processed {idx + 1}")
+    if image_store is not None:
+        image_store.prune()
+        print(image_store.summary())
+
 # Configuration
 root_dir = "out_2_augmented_images"
 output_dir = "out_4.1_converted_yolo"
 
-# Clear previous output
-shutil.rmtree(output_dir, ignore_errors=True)
-os.makedirs(output_dir)
-
-# Convert
-traverse_and_convert_yolo(root_dir, output_dir)
-print("YOLO conversion complete.")
+# keep output_dir between runs and only convert the images that changed since
+# the last run (see stage_manifest.py); outputs of removed images are deleted
+INCREMENTAL = True
+
+# export images as links to one content-addressed store shared by the export
+# stages (see image_store.py) instead of copying them; None copies
+IMAGE_STORE_DIR = "out_image_store"
+
+if __name__ == '__main__':
+    # Convert; root_dir may hold the previous stage's output as shards (see sample_shards.py)
+    if is_shard_dir(root_dir):
+        convert_shards_yolo(root_dir, output_dir)
+    else:
+        traverse_and_convert_yolo(root_dir, output_dir)
+    print("YOLO conversion complete.")
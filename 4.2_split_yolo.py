@@ -1,15 +1,24 @@
 import os
 import shutil
 import random
+from stage_manifest import get_file_digest, open_manifest
+from image_store import ImageStore
 
 # Configuration
 yolo_dir = "out_4.1_converted_yolo"  # Directory containing YOLO images and labels
 output_dir = "out_4.2_split_yolo"  # Directory to save the split datasets
-shutil.rmtree(output_dir, ignore_errors=True)  # Clear previous output
-os.makedirs(output_dir)  # Create output directory
 
 train_ratio = 0.9  # Ratio for train split
 
+# keep output_dir between runs (see stage_manifest.py): files keep the split
+# they were put in, only new files are shuffled into train/val, only changed
+# files are copied again and copies of removed files are deleted
+INCREMENTAL = True
+
+# export images as links to one content-addressed store shared by the export
+# stages (see image_store.py) instead of copying them; None copies
+IMAGE_STORE_DIR = "out_image_store"
+
 # Create split directories
 def create_split_dirs():
     for split in ['train', 'val']:
@@ -25,29 +34,58 @@ def split_files(file_list):
     return train_files, val_files
 
 # Split and move YOLO files
-def split_yolo_files():
+def split_yolo_files(manifest):
     print("Splitting YOLO files...")
     label_dir = os.path.join(yolo_dir, "labels")
     image_dir = os.path.join(yolo_dir, "images")
     label_files = [f for f in os.listdir(label_dir) if f.endswith(".txt")]
+    manifest.prune(label_files)
+    create_split_dirs()
+    image_store = ImageStore(IMAGE_STORE_DIR, file_digest=manifest.file_digest) if IMAGE_STORE_DIR else None
 
-    # Split into train and validation sets
-    train_files, val_files = split_files(label_files)
-
-    for split, files in zip(['train', 'val'], [train_files, val_files]):
+    # Files split in an earlier run stay where they are; new ones are split
+    # into train and validation sets
+    file_splits = {}
+    new_files = []
+    for label_file in label_files:
+        split = manifest.data(label_file)
+        if split is None:
+            new_files.append(label_file)
+        else:
+            file_splits[label_file] = split
+    for split, files in zip(['train', 'val'], split_files(new_files)):
         for label_file in files:
-            img_name = label_file.replace(".txt", ".jpg")
-            img_src = os.path.join(image_dir, img_name)
-            label_src = os.path.join(label_dir, label_file)
+            file_splits[label_file] = split
+
+    for label_file, split in file_splits.items():
+        img_name = label_file.replace(".txt", ".jpg")
+        img_src = os.path.join(image_dir, img_name)
+        label_src = os.path.join(label_dir, label_file)
+        if manifest.is_current(label_file, [img_src, label_src]):
+            continue
+        manifest.discard(label_file)
 
-            img_dest = os.path.join(output_dir, split, "images", img_name)
-            label_dest = os.path.join(output_dir, split, "labels", label_file)
+        img_dest = os.path.join(output_dir, split, "images", img_name)
+        label_dest = os.path.join(output_dir, split, "labels", label_file)
 
+        if image_store is not None:
+            image_store.export_file(img_src, img_dest)
+        else:
             shutil.copy(img_src, img_dest)
-            shutil.copy(label_src, label_dest)
+        shutil.copy(label_src, label_dest)
+        manifest.record(label_file, [img_src, label_src],
+                        [os.path.relpath(img_dest, output_dir), os.path.relpath(label_dest, output_dir)],
+                        data=split)
 
+    manifest.save()
+    if image_store is not None:
+        image_store.prune()
+        print(image_store.summary())
     print("YOLO dataset splitting complete.")
 
 # Run the script
-create_split_dirs()
-split_yolo_files()
+manifest = open_manifest(output_dir, {
+    'code': get_file_digest(__file__),
+    'train_ratio': train_ratio,
+}, INCREMENTAL)
+split_yolo_files(manifest)
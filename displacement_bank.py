@@ -0,0 +1,98 @@
+import json
+import random
+import hashlib
+from pathlib import Path
+
+import numpy as np
+import albumentations as A
+
+# albumentations' distortions (subclasses of its BaseDistortion: ElasticTransform,
+# GridDistortion, ...) draw a displacement field per image, turn it into the
+# absolute maps map_x/map_y and remap the image with them; bboxes are moved with
+# the same maps. The Banked* versions below take the field from a bank of fields
+# drawn beforehand instead, one bank per transform, settings and image shape.
+# A bank is a .npy file of float16 (dx, dy) pairs, shape (count, 2, height,
+# width), memory-mapped so the workers share it; displacements rather than
+# absolute maps, since float16 can not hold pixel coordinates precisely.
+# A 1024x2048 field takes 8 MB, so 256 of them are 2 GB.
+
+_banks = {}
+_identity_grids = {}
+
+
+def get_identity_grid(shape: tuple[int, int]) -> tuple[np.ndarray, np.ndarray]:
+    if shape not in _identity_grids:
+        height, width = shape
+        _identity_grids[shape] = np.meshgrid(np.arange(width, dtype=np.float32),
+                                             np.arange(height, dtype=np.float32))
+    return _identity_grids[shape]
+
+
+def open_bank(path: Path) -> np.ndarray | None:
+    """The fields of the bank at 'path', or None if it has not been built; opened once per process."""
+    if path not in _banks:
+        _banks[path] = np.load(path, mmap_mode='r') if path.exists() else None
+    return _banks[path]
+
+
+class BankedDistortionMixin:
+    """
+    Takes the displacement fields of an albumentations distortion from the
+    banks in 'bank_dir', picked with the transform's own generator, so seeding
+    works as for the original transform. Images of a shape without a bank get a
+    fresh field.
+    """
+
+    def __init__(self, *args, bank_dir, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bank_dir = Path(bank_dir)
+        self._bank_paths = {}
+
+    def get_bank_path(self, shape: tuple[int, int]) -> Path:
+        if shape not in self._bank_paths:
+            settings = {name: getattr(self, name) for name in self.get_transform_init_args_names()}
+            digest = hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()[:12]
+            # named after the Banked* class, whatever subclass of it this is
+            banked_class = next(cls for cls in type(self).__mro__ if BankedDistortionMixin in cls.__bases__)
+            base_name = banked_class.__name__.removeprefix('Banked')
+            self._bank_paths[shape] = self.bank_dir / f'{base_name}_{shape[0]}x{shape[1]}_{digest}.npy'
+        return self._bank_paths[shape]
+
+    def get_params_dependent_on_data(self, params, data):
+        shape = tuple(params['shape'][:2])
+        fields = open_bank(self.get_bank_path(shape))
+        if fields is None:
+            return super().get_params_dependent_on_data(params, data)
+
+        dx, dy = fields[getattr(self, 'py_random', random).randrange(len(fields))]
+        x, y = get_identity_grid(shape)
+        return {'map_x': x + dx, 'map_y': y + dy}
+
+    def build_bank(self, shape: tuple[int, int], count: int, seed: int) -> Path:
+        """Draws 'count' fields for images of 'shape' into a bank, unless it exists."""
+        path = self.get_bank_path(shape)
+        if path.exists():
+            return path
+
+        self.bank_dir.mkdir(parents=True, exist_ok=True)
+        if hasattr(self, 'set_random_seed'):
+            self.set_random_seed(seed)
+        x, y = get_identity_grid(shape)
+        tmp_path = path.with_suffix('.tmp.npy')
+        fields = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float16, shape=(count, 2, *shape))
+        for i in range(count):
+            maps = super().get_params_dependent_on_data({'shape': shape}, {})
+            fields[i, 0] = maps['map_x'] - x
+            fields[i, 1] = maps['map_y'] - y
+        fields.flush()
+        del fields
+        tmp_path.replace(path)
+        return path
+
+
+class BankedElasticTransform(BankedDistortionMixin, A.ElasticTransform):
+    pass
+
+
+class BankedGridDistortion(BankedDistortionMixin, A.GridDistortion):
+    pass
@@ -0,0 +1,115 @@
+import json
+import mmap
+import random
+import struct
+from pathlib import Path
+
+import numpy as np
+
+# File layout (all arrays little-endian, 8-byte aligned):
+#   b'FVB1' | uint32 header size | header json | uint16 lengths[N] | uint64 offsets[N+1] | utf-8 data
+# Values are grouped into named sections and sorted by length inside each section,
+# so a value of a given length is found with a binary search over 'lengths'.
+# The header also keeps the parameters the bank was built with ('params'), so a
+# bank built with other ones can be told apart.
+MAGIC = b'FVB1'
+
+
+def _align(pos: int) -> int:
+    return (pos + 7) // 8 * 8
+
+
+def _read_header(buffer, path: Path) -> tuple[int, dict]:
+    if buffer[:4] != MAGIC:
+        raise ValueError(f"{path} is not a fake value bank")
+    header_size, = struct.unpack_from('<I', buffer, 4)
+    return header_size, json.loads(buffer[8:8 + header_size])
+
+
+def read_fake_value_bank_params(path: Path) -> dict | None:
+    """Parameters the bank at 'path' was built with (None for banks written without them)."""
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return _read_header(mm, path)[1].get('params')
+
+
+def write_fake_value_bank(path: Path, sections: dict[str, list[str]], params: dict | None = None) -> None:
+    values, section_bounds = [], {}
+    for name, section_values in sections.items():
+        start = len(values)
+        values.extend(sorted(section_values, key=len))
+        section_bounds[name] = [start, len(values)]
+
+    encoded = [value.encode('utf-8') for value in values]
+    lengths = np.array([len(value) for value in values], dtype='<u2')
+    offsets = np.zeros(len(values) + 1, dtype='<u8')
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+
+    header = json.dumps({'count': len(values), 'sections': section_bounds, 'params': params}).encode('utf-8')
+    lengths_pos = _align(8 + len(header))
+    offsets_pos = _align(lengths_pos + lengths.nbytes)
+    data_pos = offsets_pos + offsets.nbytes
+
+    tmp_path = Path(str(path) + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC + struct.pack('<I', len(header)) + header)
+        f.write(b'\0' * (lengths_pos - f.tell()))
+        f.write(lengths.tobytes())
+        f.write(b'\0' * (offsets_pos - f.tell()))
+        f.write(offsets.tobytes())
+        assert f.tell() == data_pos
+        f.write(b''.join(encoded))
+    tmp_path.replace(path)
+
+
+class FakeValueBank:
+    """
+    Read-only view of a bank written by write_fake_value_bank. The file is
+    memory-mapped, so every process that opens it shares the same pages.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        with open(self.path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header_size, header = _read_header(self._mm, self.path)
+
+        count = header['count']
+        self.params = header.get('params')
+        self.sections = {name: tuple(bounds) for name, bounds in header['sections'].items()}
+        lengths_pos = _align(8 + header_size)
+        offsets_pos = _align(lengths_pos + 2 * count)
+        self.lengths = np.frombuffer(self._mm, dtype='<u2', count=count, offset=lengths_pos)
+        self.offsets = np.frombuffer(self._mm, dtype='<u8', count=count + 1, offset=offsets_pos)
+        self._data_pos = offsets_pos + self.offsets.nbytes
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def value(self, idx: int) -> str:
+        start = self._data_pos + int(self.offsets[idx])
+        end = self._data_pos + int(self.offsets[idx + 1])
+        return self._mm[start:end].decode('utf-8')
+
+    def choice(self, section: str) -> str:
+        start, end = self.sections[section]
+        return self.value(random.randrange(start, end))
+
+    def pick(self, max_chars: int, section: str = 'text', min_candidates: int = 64) -> str:
+        """
+        Random value of 'section' that fits in max_chars, drawn from the values
+        closest to max_chars in length (within max_chars // 4 of it, and never
+        fewer than min_candidates of them). If no value is short enough, one of
+        the shortest is cut to max_chars - 2, as select_text_widthwise does.
+        """
+        start, end = self.sections[section]
+        lengths = self.lengths[start:end]
+
+        hi = int(np.searchsorted(lengths, max_chars, side='left'))
+        if hi == 0:
+            idx = random.randrange(0, min(min_candidates, len(lengths)))
+            return self.value(start + idx)[:max_chars - 2]
+
+        lo = int(np.searchsorted(lengths, max_chars - max(1, max_chars // 4), side='left'))
+        lo = max(0, min(lo, hi - min_candidates))
+        return self.value(start + random.randrange(lo, hi))
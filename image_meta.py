@@ -0,0 +1,108 @@
+import io
+import os
+import json
+import struct
+from pathlib import Path
+
+# Image sizes without decoding: width and height are read from the PNG IHDR chunk
+# or the JPEG SOFn segment, walking the segments before it by their lengths, so
+# only a few hundred bytes are read for the JPEGs the stages write.
+#
+# A stage can also store an image's size in its widget JSON, under IMAGE_KEY:
+#   {"<widget name>": {...}, ..., "__image__": {"width": w, "height": h}}
+# Stages that change the image (crop, augment) update it; everything that walks
+# the widgets of a JSON skips it.
+IMAGE_KEY = '__image__'
+CACHE_NAME = '.image_sizes'
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# SOF0-SOF15, except DHT (C4), JPG (C8) and DAC (CC)
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def read_image_size(f) -> tuple[int, int] | None:
+    """(width, height) of the PNG or JPEG in binary file 'f', or None if it is neither."""
+    head = f.read(24)
+    if head[:8] == PNG_SIGNATURE and head[12:16] == b'IHDR':
+        return struct.unpack('>II', head[16:24])
+    if head[:2] != b'\xff\xd8':
+        return None
+
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        # fill bytes (0xFF) may precede a marker
+        while marker[:1] == b'\xff' and marker[1:] == b'\xff':
+            marker = b'\xff' + f.read(1)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        if marker[1] in (0xD8, 0x01) or 0xD0 <= marker[1] <= 0xD7:
+            continue  # segments without a length
+        if marker[1] in (0xD9, 0xDA):
+            return None  # end of image or start of scan before any frame header
+        length = f.read(2)
+        if len(length) < 2:
+            return None
+        if marker[1] in JPEG_SOF_MARKERS:
+            frame = f.read(5)
+            if len(frame) < 5:
+                return None
+            height, width = struct.unpack('>HH', frame[1:5])
+            return width, height
+        f.seek(struct.unpack('>H', length)[0] - 2, os.SEEK_CUR)
+
+
+def probe_image_size(data: bytes) -> tuple[int, int] | None:
+    return read_image_size(io.BytesIO(data))
+
+
+def probe_image_file(path) -> tuple[int, int] | None:
+    with open(path, 'rb') as f:
+        return read_image_size(f)
+
+
+def with_image_size(widgets: dict, image) -> dict:
+    """'widgets' with the size of 'image' (an array) stored under IMAGE_KEY."""
+    height, width = image.shape[:2]
+    return {**widgets, IMAGE_KEY: {'width': width, 'height': height}}
+
+
+def get_stored_image_size(widgets: dict) -> tuple[int, int] | None:
+    size = widgets.get(IMAGE_KEY)
+    return (size['width'], size['height']) if size is not None else None
+
+
+class ImageSizeCache:
+    """
+    Image sizes by path, kept in 'cache_path' between runs and probed again
+    only for files whose (mtime, size) changed. Only the entries looked up in a
+    run are saved.
+    """
+
+    def __init__(self, cache_path):
+        self.cache_path = Path(cache_path)
+        self.entries = {}
+        if self.cache_path.exists():
+            with open(self.cache_path, 'r') as f:
+                self.entries = json.load(f)
+        self._used = {}
+
+    def get(self, path) -> tuple[int, int] | None:
+        path = str(path)
+        stat = os.stat(path)
+        entry = self.entries.get(path)
+        if entry is None or entry[:2] != [stat.st_mtime_ns, stat.st_size]:
+            size = probe_image_file(path)
+            entry = [stat.st_mtime_ns, stat.st_size, *size] if size is not None else None
+            self.entries[path] = entry
+        if entry is None:
+            return None
+        self._used[path] = entry
+        return entry[2], entry[3]
+
+    def save(self) -> None:
+        os.makedirs(self.cache_path.parent, exist_ok=True)
+        tmp_path = Path(str(self.cache_path) + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self._used, f)
+        tmp_path.replace(self.cache_path)
@@ -0,0 +1,143 @@
+import os
+import errno
+import shutil
+import hashlib
+from pathlib import Path
+
+from stage_manifest import get_file_digest
+
+try:
+    import fcntl
+except ImportError:  # Windows: no reflinks
+    fcntl = None
+
+# The export stages each put every image into their images/ tree. Rather than a
+# copy per stage, an ImageStore keeps one file per content,
+#   <store_dir>/<sha256[:2]>/<sha256><suffix>
+# and the exports are links to it, made with the first of the link modes that
+# works:
+#   reflink   a copy-on-write clone (Linux, on btrfs, XFS, ...): shares the
+#             data blocks but is a file of its own
+#   hardlink  the store file under another name; same filesystem only
+#   symlink   points at the store file, which then has to stay where it is
+#   copy      a plain copy, e.g. when the export is on another filesystem
+# Files enter the store as reflinks or copies, never hardlinks, since the
+# stages rewrite their own outputs in place. Exports are replaced, never written
+# into, and must not be edited in place either: a hardlinked export is the store
+# file, and every other export of the same content with it. Apart from
+# symlinks, exports do not need the store once made, so it can be deleted
+# between runs (it is then filled again). The export stages prune it after
+# exporting: a store file no export is hardlinked to any more is deleted.
+FICLONE = 0x40049409  # from linux/fs.h
+LINK_MODES = ('reflink', 'hardlink', 'copy')
+
+
+def reflink(src, dst) -> None:
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'reflinks are not supported here')
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+
+
+def link_file(src, dst, modes=LINK_MODES) -> str:
+    """
+    Replaces 'dst' with a link to 'src', made with the first of 'modes' that
+    works; returns that mode.
+    """
+    dst = Path(dst)
+    tmp_path = dst.with_name(dst.name + '.tmp')
+    error = None
+    for mode in modes:
+        tmp_path.unlink(missing_ok=True)
+        try:
+            if mode == 'reflink':
+                reflink(src, tmp_path)
+            elif mode == 'hardlink':
+                os.link(src, tmp_path)
+            elif mode == 'symlink':
+                os.symlink(os.path.abspath(src), tmp_path)
+            elif mode == 'copy':
+                shutil.copyfile(src, tmp_path)
+            else:
+                raise ValueError(f'unknown link mode {mode}')
+        except OSError as e:
+            error = e
+            continue
+        # a new file in place of the old one, so an old hardlink is not written into
+        tmp_path.replace(dst)
+        return mode
+
+    tmp_path.unlink(missing_ok=True)
+    raise error
+
+
+class ImageStore:
+    """
+    Files by content in 'store_dir', and exports linked to them with the first
+    of 'link_modes' that works. 'file_digest' gives the sha256 of a file, e.g.
+    a StageManifest's, which already has those of the stage's inputs.
+    """
+
+    def __init__(self, store_dir, link_modes=LINK_MODES, file_digest=get_file_digest):
+        self.store_dir = Path(store_dir)
+        self.link_modes = link_modes
+        self.file_digest = file_digest
+        self.counts = {}  # link mode -> exports made with it
+        self.pruned = (0, 0)  # store files deleted by prune, and their bytes
+
+    def get_path(self, digest: str, suffix: str = '') -> Path:
+        return self.store_dir / digest[:2] / f'{digest}{suffix}'
+
+    def _export(self, store_path: Path, dest) -> None:
+        mode = link_file(store_path, dest, self.link_modes)
+        self.counts[mode] = self.counts.get(mode, 0) + 1
+
+    def export_file(self, src, dest) -> None:
+        """Makes 'dest' a link to the store file with the content of 'src', adding it if needed."""
+        store_path = self.get_path(self.file_digest(src), Path(dest).suffix)
+        if not store_path.exists():
+            store_path.parent.mkdir(parents=True, exist_ok=True)
+            link_file(src, store_path, ('reflink', 'copy'))
+        self._export(store_path, dest)
+
+    def export_bytes(self, data: bytes, dest) -> None:
+        """Same as export_file for a file with content 'data'."""
+        store_path = self.get_path(hashlib.sha256(data).hexdigest(), Path(dest).suffix)
+        if not store_path.exists():
+            store_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = store_path.with_name(store_path.name + '.tmp')
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            tmp_path.replace(store_path)
+        self._export(store_path, dest)
+
+    def prune(self) -> tuple[int, int]:
+        """
+        Deletes the store files that no export is hardlinked to (link count 1),
+        and returns how many there were and their bytes. Reflinked and copied
+        exports do not need their store file; symlinked ones do but can not be
+        told apart, so with 'symlink' among the link modes nothing is deleted.
+        """
+        if 'symlink' in self.link_modes or not self.store_dir.is_dir():
+            return self.pruned
+        count = size = 0
+        for subdir in self.store_dir.iterdir():
+            if not subdir.is_dir():
+                continue
+            for path in subdir.iterdir():
+                stat = path.lstat()
+                if stat.st_nlink == 1:
+                    path.unlink()
+                    count += 1
+                    size += stat.st_size
+            if not any(subdir.iterdir()):
+                subdir.rmdir()
+        self.pruned = (count, size)
+        return self.pruned
+
+    def summary(self) -> str:
+        counts = ', '.join(f'{count} {mode}' for mode, count in sorted(self.counts.items()))
+        summary = f"images exported from {self.store_dir}: {counts or 'none'}"
+        if self.pruned[0]:
+            summary += f'; {self.pruned[0]} unused store files deleted ({self.pruned[1] / 2**20:.1f} MB)'
+        return summary
@@ -0,0 +1,131 @@
+import os
+import json
+from pathlib import Path
+
+import numpy as np
+
+# A raster set holds decoded uint8 images, so a stage can hand its images to the
+# next one without a JPEG encode and decode (and the compression artifacts that
+# stack up with each of them). Images are written back to back, row-major and
+# without any header, into pack files of at most max_pack_bytes, each image
+# starting at a multiple of ALIGNMENT. rasters.json, written last, has per key
+# (like '<doc_type>/<stem>', see sample_shards.py) the pack, the byte offset and
+# the shape of the image, and the widget annotations:
+#   {"packs": [name, ...], "samples": {key: [pack, offset, *shape]}, "widgets": {key: widgets}}
+# Readers map the packs and return read-only views into them: no decode, no copy.
+# Rasters are large (a 2550x3300 page is 25 MB), so this is for handoffs between
+# the stages of one run rather than for keeping datasets around.
+INDEX_NAME = 'rasters.json'
+MAX_PACK_BYTES = 1 << 32
+ALIGNMENT = 4096
+
+
+def is_raster_dir(path) -> bool:
+    return (Path(path) / INDEX_NAME).exists()
+
+
+class RasterWriter:
+    """Streams images into the packs of 'raster_dir'; the index is written on close."""
+
+    def __init__(self, raster_dir, max_pack_bytes: int = MAX_PACK_BYTES):
+        self.raster_dir = Path(raster_dir)
+        self.max_pack_bytes = max_pack_bytes
+        os.makedirs(self.raster_dir, exist_ok=True)
+
+        self.packs = []
+        self.samples = {}
+        self.widgets = {}
+        self._pack = None
+        self._offset = 0
+
+    def write(self, key: str, image: np.ndarray, widgets: dict) -> None:
+        if key in self.samples:
+            raise ValueError(f'duplicate sample key {key}')
+        if image.dtype != np.uint8:
+            raise ValueError(f'{key}: expected a uint8 image, got {image.dtype}')
+        if self._pack is not None and self._offset + image.nbytes > self.max_pack_bytes:
+            self._close_pack()
+        if self._pack is None:
+            self.packs.append(f'pack-{len(self.packs):06d}.raw')
+            self._pack = open(self.raster_dir / self.packs[-1], 'wb')
+            self._offset = 0
+
+        padding = -self._offset % ALIGNMENT
+        if padding:
+            self._pack.write(bytes(padding))
+            self._offset += padding
+        # rows of a full-width crop are already contiguous, so this writes the
+        # caller's buffer as it is
+        self._pack.write(np.ascontiguousarray(image).data)
+        self.samples[key] = [len(self.packs) - 1, self._offset, *image.shape]
+        self.widgets[key] = widgets
+        self._offset += image.nbytes
+
+    def _close_pack(self) -> None:
+        self._pack.close()
+        self._pack = None
+
+    def close(self, write_index: bool = True) -> None:
+        if self._pack is not None:
+            self._close_pack()
+        if not write_index:
+            return
+        tmp_path = self.raster_dir / (INDEX_NAME + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'packs': self.packs, 'samples': self.samples, 'widgets': self.widgets}, f)
+        tmp_path.replace(self.raster_dir / INDEX_NAME)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # without an index a half-written raster set is not mistaken for a complete one
+        self.close(write_index=exc_type is None)
+
+
+class RasterReader:
+    """
+    Images of a raster set written by RasterWriter, by key (read) or in the
+    order they were written (iteration), as read-only arrays backed by the
+    memory-mapped packs. Packs are mapped once, so forked workers share them.
+    """
+
+    def __init__(self, raster_dir):
+        self.raster_dir = Path(raster_dir)
+        with open(self.raster_dir / INDEX_NAME, 'r') as f:
+            index = json.load(f)
+        self.packs = index['packs']
+        self.samples = index['samples']
+        self.widgets = index['widgets']
+        self._maps = {}
+
+    def __len__(self) -> int:
+        return len(self.samples)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.samples
+
+    def keys(self) -> list[str]:
+        return list(self.samples)
+
+    def read(self, key: str) -> tuple[np.ndarray, dict]:
+        pack, offset, *shape = self.samples[key]
+        if pack not in self._maps:
+            self._maps[pack] = np.memmap(self.raster_dir / self.packs[pack], dtype=np.uint8, mode='r')
+        image = self._maps[pack][offset:offset + int(np.prod(shape))].reshape(shape).view(np.ndarray)
+        return image, self.widgets[key]
+
+    def __iter__(self):
+        for key in self.samples:
+            yield key, *self.read(key)
+
+    def close(self) -> None:
+        # views handed out keep their pack mapped until they are released
+        self._maps = {}
+
+
+def read_rasters(root):
+    """Yields (key, image, widgets) for every image of the raster set at 'root'."""
+    reader = RasterReader(root)
+    yield from reader
+    reader.close()
@@ -0,0 +1,212 @@
+import io
+import os
+import json
+import tarfile
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+# A shard set is a directory of tar files in the WebDataset layout: every sample
+# is a '<key>.jpg' member (the encoded image) followed by a '<key>.json' member
+# (its widget annotations), with keys like '<doc_type>/<stem>'. Shards are closed
+# once they reach max_shard_bytes or max_shard_samples. index.json, written last,
+# lists the shards and, per key, where the bytes of both members start and end,
+# so samples can be read directly instead of scanning the tar files:
+#   {"shards": [name, ...], "samples": {key: [shard, image_offset, image_size, json_offset, json_size]}}
+# The same samples as plain files are '<doc_type>/image/<stem>.jpg' and
+# '<doc_type>/json/<stem>.json', the layout of the stage output directories.
+INDEX_NAME = 'index.json'
+MAX_SHARD_BYTES = 1 << 30
+MAX_SHARD_SAMPLES = 10000
+
+
+def image_relpath(key: str) -> str:
+    doc_type, stem = key.rsplit('/', 1)
+    return f'{doc_type}/image/{stem}.jpg'
+
+
+def json_relpath(key: str) -> str:
+    doc_type, stem = key.rsplit('/', 1)
+    return f'{doc_type}/json/{stem}.json'
+
+
+def encode_image(image: np.ndarray) -> bytes:
+    ok, encoded = cv2.imencode('.jpg', image)
+    if not ok:
+        raise ValueError('could not encode image')
+    return encoded.tobytes()
+
+
+def decode_image(data: bytes) -> np.ndarray | None:
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+
+
+def is_shard_dir(path) -> bool:
+    return (Path(path) / INDEX_NAME).exists()
+
+
+class ShardWriter:
+    """Streams samples into the shards of 'shard_dir'; the index is written on close."""
+
+    def __init__(self, shard_dir, max_shard_bytes: int = MAX_SHARD_BYTES,
+                 max_shard_samples: int = MAX_SHARD_SAMPLES):
+        self.shard_dir = Path(shard_dir)
+        self.max_shard_bytes = max_shard_bytes
+        self.max_shard_samples = max_shard_samples
+        os.makedirs(self.shard_dir, exist_ok=True)
+
+        self.shards = []
+        self.samples = {}
+        self._tar = None
+        self._shard_samples = 0
+
+    def _add_member(self, name: str, data: bytes) -> tuple[int, int]:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        self._tar.addfile(info, io.BytesIO(data))
+        # the member's data ends the archive so far, padded to a whole block
+        padded_size = -(-len(data) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        return self._tar.offset - padded_size, len(data)
+
+    def write(self, key: str, image_bytes: bytes, widgets: dict) -> None:
+        if key in self.samples:
+            raise ValueError(f'duplicate sample key {key}')
+        if self._tar is not None and (self._tar.offset >= self.max_shard_bytes
+                                      or self._shard_samples >= self.max_shard_samples):
+            self._close_shard()
+        if self._tar is None:
+            self.shards.append(f'shard-{len(self.shards):06d}.tar')
+            self._tar = tarfile.open(self.shard_dir / self.shards[-1], 'w', format=tarfile.PAX_FORMAT)
+            self._shard_samples = 0
+
+        image_offset, image_size = self._add_member(f'{key}.jpg', image_bytes)
+        json_offset, json_size = self._add_member(f'{key}.json', json.dumps(widgets).encode('utf-8'))
+        self.samples[key] = [len(self.shards) - 1, image_offset, image_size, json_offset, json_size]
+        self._shard_samples += 1
+
+    def _close_shard(self) -> None:
+        self._tar.close()
+        self._tar = None
+
+    def close(self, write_index: bool = True) -> None:
+        if self._tar is not None:
+            self._close_shard()
+        if not write_index:
+            return
+        tmp_path = self.shard_dir / (INDEX_NAME + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'shards': self.shards, 'samples': self.samples}, f)
+        tmp_path.replace(self.shard_dir / INDEX_NAME)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # without an index a half-written shard set is not mistaken for a complete one
+        self.close(write_index=exc_type is None)
+
+
+class ShardReader:
+    """
+    Samples of a shard set written by ShardWriter, by key (read) or in the
+    order they were written (iteration). Shard files are opened once and read
+    with pread, so a reader can be shared by forked workers.
+    """
+
+    def __init__(self, shard_dir):
+        self.shard_dir = Path(shard_dir)
+        with open(self.shard_dir / INDEX_NAME, 'r') as f:
+            index = json.load(f)
+        self.shards = index['shards']
+        self.samples = index['samples']
+        self._fds = {}
+
+    def __len__(self) -> int:
+        return len(self.samples)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.samples
+
+    def keys(self) -> list[str]:
+        return list(self.samples)
+
+    def _pread(self, shard: int, offset: int, size: int) -> bytes:
+        if shard not in self._fds:
+            self._fds[shard] = os.open(self.shard_dir / self.shards[shard], os.O_RDONLY)
+        return os.pread(self._fds[shard], size, offset)
+
+    def read(self, key: str) -> tuple[bytes, dict]:
+        shard, image_offset, image_size, json_offset, json_size = self.samples[key]
+        image_bytes = self._pread(shard, image_offset, image_size)
+        widgets = json.loads(self._pread(shard, json_offset, json_size))
+        return image_bytes, widgets
+
+    def __iter__(self):
+        for key in self.samples:
+            yield key, *self.read(key)
+
+    def close(self) -> None:
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds = {}
+
+
+def read_samples(root):
+    """
+    Yields (key, image_bytes, widgets) for every sample under 'root', a shard
+    set or a stage output directory (samples with an image and a JSON, sorted).
+    """
+    root = Path(root)
+    if is_shard_dir(root):
+        reader = ShardReader(root)
+        yield from reader
+        reader.close()
+        return
+
+    for json_path in sorted(root.glob('*/json/*.json')):
+        key = f'{json_path.parent.parent.name}/{json_path.stem}'
+        image_path = root / image_relpath(key)
+        if not image_path.exists():
+            print(f'No image found for {json_path}')
+            continue
+        with open(json_path, 'r') as f:
+            widgets = json.load(f)
+        yield key, image_path.read_bytes(), widgets
+
+
+class SampleWriter:
+    """
+    Writes samples to 'root' as a shard set (shards=True) or as plain files in
+    the stage output layout.
+    """
+
+    def __init__(self, root, shards: bool):
+        self.root = Path(root)
+        os.makedirs(self.root, exist_ok=True)
+        self._shard_writer = ShardWriter(self.root) if shards else None
+        self._dirs = set()
+
+    def write(self, key: str, image_bytes: bytes, widgets: dict) -> None:
+        if self._shard_writer is not None:
+            self._shard_writer.write(key, image_bytes, widgets)
+            return
+
+        image_path, json_path = self.root / image_relpath(key), self.root / json_relpath(key)
+        for directory in (image_path.parent, json_path.parent):
+            if directory not in self._dirs:
+                os.makedirs(directory, exist_ok=True)
+                self._dirs.add(directory)
+        image_path.write_bytes(image_bytes)
+        with open(json_path, 'w') as f:
+            json.dump(widgets, f, indent=4)
+
+    def close(self, write_index: bool = True) -> None:
+        if self._shard_writer is not None:
+            self._shard_writer.close(write_index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(write_index=exc_type is None)
@@ -0,0 +1,132 @@
+import os
+import json
+import shutil
+import hashlib
+from pathlib import Path
+
+# Every stage keeps a manifest in its output directory with one entry per work
+# item (a template, an image, ...):
+#   {"entries": {key: {"config": <hash of stage config, code and seed>,
+#                      "inputs": {path: [sha256, mtime_ns, size]},
+#                      "outputs": [paths relative to the output directory],
+#                      "data": <anything the stage wants back on a rerun>}}}
+# An item is redone when the stage config or the content of one of its inputs
+# changed, or one of its outputs is gone. Inputs are only re-hashed when their
+# (mtime, size) differs from what the manifest last saw. The file is JSON, but
+# named so the stages' scans for *.json annotations do not pick it up.
+MANIFEST_NAME = '.manifest'
+
+
+def get_file_digest(path) -> str:
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def get_config_hash(config: dict) -> str:
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class StageManifest:
+    def __init__(self, out_dir, config: dict):
+        self.out_dir = Path(out_dir)
+        self.path = self.out_dir / MANIFEST_NAME
+        self.config_hash = get_config_hash(config)
+        self.entries = {}
+        if self.path.exists():
+            with open(self.path, 'r') as f:
+                self.entries = json.load(f)['entries']
+
+        # (sha256, mtime_ns, size) of every input seen, seeded from the manifest
+        # so unchanged files are never read again
+        self._file_states = {}
+        for entry in self.entries.values():
+            self._file_states.update(entry['inputs'])
+
+    def file_state(self, path) -> list:
+        path = str(path)
+        stat = os.stat(path)
+        state = self._file_states.get(path)
+        if state is None or state[1:] != [stat.st_mtime_ns, stat.st_size]:
+            state = [get_file_digest(path), stat.st_mtime_ns, stat.st_size]
+            self._file_states[path] = state
+        return state
+
+    def file_digest(self, path) -> str:
+        return self.file_state(path)[0]
+
+    def is_current(self, key: str, inputs: list) -> bool:
+        entry = self.entries.get(key)
+        if entry is None or entry['config'] != self.config_hash:
+            return False
+        if sorted(entry['inputs']) != sorted(str(path) for path in inputs):
+            return False
+        for path in inputs:
+            if not os.path.exists(path) or self.file_state(path)[0] != entry['inputs'][str(path)][0]:
+                return False
+        return all((self.out_dir / output).exists() for output in entry['outputs'])
+
+    def record(self, key: str, inputs: list, outputs: list, data=None) -> None:
+        self.entries[key] = {
+            'config': self.config_hash,
+            'inputs': {str(path): self.file_state(path) for path in inputs},
+            'outputs': [str(output) for output in outputs],
+            'data': data,
+        }
+
+    def data(self, key: str):
+        """Data recorded for 'key', if it was recorded with the current config."""
+        entry = self.entries.get(key)
+        if entry is None or entry['config'] != self.config_hash:
+            return None
+        return entry['data']
+
+    def discard(self, key: str) -> None:
+        """Deletes the outputs recorded for 'key' and forgets the entry."""
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for output in entry['outputs']:
+            output_path = self.out_dir / output
+            if output_path.is_dir():
+                shutil.rmtree(output_path, ignore_errors=True)
+            elif output_path.exists():
+                output_path.unlink()
+
+    def prune(self, keys) -> list[str]:
+        """Discards the entries whose key is not in 'keys', i.e. whose input is gone."""
+        keys = set(keys)
+        removed = [key for key in self.entries if key not in keys]
+        directories = set()
+        for key in removed:
+            for output in self.entries[key]['outputs']:
+                directories.update((self.out_dir / output).parents)
+            self.discard(key)
+
+        # and the directories that are left empty, deepest first
+        for directory in sorted(directories, key=lambda path: len(path.parts), reverse=True):
+            if directory != self.out_dir and directory.is_relative_to(self.out_dir) \
+                    and directory.is_dir() and not any(directory.iterdir()):
+                directory.rmdir()
+        return removed
+
+    def save(self) -> None:
+        tmp_path = Path(str(self.path) + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'entries': self.entries}, f)
+        tmp_path.replace(self.path)
+
+
+def open_manifest(out_dir, config: dict, incremental: bool = True) -> StageManifest:
+    """
+    Manifest of a stage's output directory. Without one to go by (first run, or
+    incremental runs turned off) the directory is cleared, as every stage used
+    to do, so nothing untracked is left in it.
+    """
+    out_dir = Path(out_dir)
+    if not incremental or not (out_dir / MANIFEST_NAME).exists():
+        shutil.rmtree(out_dir, ignore_errors=True)
+    os.makedirs(out_dir, exist_ok=True)
+    return StageManifest(out_dir, config)
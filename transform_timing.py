@@ -0,0 +1,131 @@
+import csv
+import time
+import types
+
+# Wall time of the transforms of an albumentations Compose. time_transforms turns
+# each transform into a Timed<Name> subclass of its own class that reports every
+# call it applies (parameter drawing included) to a TransformTimer, with the
+# image shape. The timer can also hold every image to a time budget: once
+# start_image has been called, a transform whose mean time so far would take
+# the image past the budget is skipped. Which transforms are skipped then
+# depends on timings, so outputs are only reproducible without a budget.
+#
+# Calls are (transform, height, width, seconds, skipped) rows; a timer keeps
+# them until drained, so worker processes can send theirs to the parent, which
+# sums them up with TimingStats.
+
+_timed_classes = {}
+
+
+class TimedTransformMixin:
+    timer = None
+
+    def should_apply(self, force_apply: bool = False) -> bool:
+        # the original draw always happens, so timing alone changes no outcome
+        self._timed_applied = super().should_apply(force_apply=force_apply)
+        if self._timed_applied and self.timer.should_skip(self._timed_name, self._timed_shape):
+            self.timer.record(self._timed_name, self._timed_shape, 0.0, skipped=True)
+            self._timed_applied = False
+        return self._timed_applied
+
+    def __call__(self, *args, force_apply: bool = False, **kwargs):
+        self._timed_shape = kwargs['image'].shape[:2] if 'image' in kwargs else None
+        self._timed_applied = False
+        start = time.perf_counter()
+        data = super().__call__(*args, force_apply=force_apply, **kwargs)
+        if self._timed_applied:
+            self.timer.record(self._timed_name, self._timed_shape, time.perf_counter() - start)
+        return data
+
+
+def get_timed_class(cls: type) -> type:
+    if cls not in _timed_classes:
+        _timed_classes[cls] = types.new_class(f'Timed{cls.__name__}', (TimedTransformMixin, cls))
+    return _timed_classes[cls]
+
+
+def time_transforms(compose, timer: 'TransformTimer'):
+    """Makes every transform of 'compose' report to 'timer'; returns 'compose'."""
+    for transform in compose.transforms:
+        name = type(transform).__name__
+        transform.__class__ = get_timed_class(type(transform))
+        transform.timer = timer
+        transform._timed_name = name
+    return compose
+
+
+class TransformTimer:
+    """
+    Collects the calls of timed transforms in one process and, with 'budget_ms',
+    skips the transforms that would take an image past it.
+    """
+
+    def __init__(self, budget_ms: float | None = None):
+        self.budget = budget_ms / 1000 if budget_ms is not None else None
+        self.calls = []
+        self._means = {}  # (transform, shape) -> [calls, seconds], for the budget
+        self._image_start = None
+
+    def start_image(self) -> None:
+        self._image_start = time.perf_counter()
+
+    def should_skip(self, name: str, shape) -> bool:
+        if self.budget is None or self._image_start is None or (name, shape) not in self._means:
+            return False
+        calls, seconds = self._means[(name, shape)]
+        return time.perf_counter() - self._image_start + seconds / calls > self.budget
+
+    def record(self, name: str, shape, seconds: float, skipped: bool = False) -> None:
+        height, width = shape if shape is not None else (None, None)
+        self.calls.append((name, height, width, seconds, skipped))
+        if not skipped:
+            mean = self._means.setdefault((name, shape), [0, 0.0])
+            mean[0] += 1
+            mean[1] += seconds
+
+    def drain(self) -> list[tuple]:
+        calls, self.calls = self.calls, []
+        return calls
+
+
+class TimingStats:
+    """
+    Sums up call rows per transform and image shape, and formats them as a
+    table; with 'log_path', every row is also written there as CSV.
+    """
+
+    def __init__(self, log_path=None):
+        self.totals = {}  # (transform, height, width) -> [calls, skipped, seconds, max seconds]
+        self._log = open(log_path, 'w', newline='') if log_path is not None else None
+        if self._log:
+            self._log_writer = csv.writer(self._log)
+            self._log_writer.writerow(['transform', 'height', 'width', 'seconds', 'skipped'])
+
+    def add(self, calls: list[tuple]) -> None:
+        if self._log:
+            self._log_writer.writerows(calls)
+        for name, height, width, seconds, skipped in calls:
+            total = self.totals.setdefault((name, height, width), [0, 0, 0.0, 0.0])
+            if skipped:
+                total[1] += 1
+                continue
+            total[0] += 1
+            total[2] += seconds
+            total[3] = max(total[3], seconds)
+
+    def table(self) -> str:
+        all_seconds = sum(total[2] for total in self.totals.values()) or 1.0
+        lines = [f"{'transform':<26}{'shape':>12}{'calls':>8}{'skipped':>9}{'mean ms':>10}{'max ms':>10}"
+                 f"{'total s':>10}{'share':>8}"]
+        for (name, height, width), (calls, skipped, seconds, max_seconds) in sorted(
+                self.totals.items(), key=lambda item: -item[1][2]):
+            shape = f'{height}x{width}' if height is not None else '-'
+            mean_ms = 1000 * seconds / calls if calls else 0.0
+            lines.append(f'{name:<26}{shape:>12}{calls:>8}{skipped:>9}{mean_ms:>10.1f}{1000 * max_seconds:>10.1f}'
+                         f'{seconds:>10.2f}{seconds / all_seconds:>8.1%}')
+        return '\n'.join(lines)
+
+    def close(self) -> None:
+        if self._log:
+            self._log.close()
+            self._log = None
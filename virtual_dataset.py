@@ -0,0 +1,284 @@
+import json
+import random
+import hashlib
+import importlib.util
+import itertools
+import multiprocessing
+from collections import OrderedDict, deque, namedtuple
+from multiprocessing.connection import Client, Listener
+from pathlib import Path
+
+import numpy as np
+
+# A virtual dataset keeps no images, only one record per final sample:
+#   (template pdf, page, sample seed, crop offset, augmentation seed)
+# and renders a sample when it is asked for, with the same chain as the stage
+# scripts: fill + rasterize (0_generate_random_data.py), crop (1_crop_images_vertically.py),
+# augment (2_augment_images.py). The same record always gives the same sample.
+#
+# The stage scripts, and PyMuPDF with them, are only imported once a
+# VirtualDataset is created, so a training process can use VirtualDatasetClient
+# to read from a prefetching server (serve) with numpy alone.
+
+VirtualRecord = namedtuple('VirtualRecord', ['template', 'page_num', 'sample_seed', 'crop_offset', 'augment_seed'])
+
+_stages = {}
+
+
+def load_stage(filename):
+    """
+    Imports one of the numbered stage scripts as a module (see 0-4_fused_pipeline.py),
+    once per process.
+    """
+    if filename not in _stages:
+        path = Path(__file__).parent / filename
+        spec = importlib.util.spec_from_file_location(path.stem.replace('.', '_').replace('-', '_'), path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _stages[filename] = module
+    return _stages[filename]
+
+
+def get_augment_seed(sample_seed: int, crop_no: int) -> int:
+    key = f"{sample_seed}|{crop_no}|augment".encode()
+    return int.from_bytes(hashlib.sha256(key).digest()[:8], 'big')
+
+
+def build_records(pdf_paths: list[Path], samples_per_page: int, global_seed: int,
+                  crop_height: int) -> list[VirtualRecord]:
+    """
+    Records of every crop of every (pdf, page, sample) unit. Sample seeds are
+    the ones 0_generate_random_data.py gives the units; the crop offsets are
+    drawn from the sample seed, which is possible without rendering anything
+    since every raster is PAGE_HEIGHT high.
+    """
+    stage_generate = load_stage('0_generate_random_data.py')
+    stage_crop = load_stage('1_crop_images_vertically.py')
+
+    records = []
+    for pdf_path in pdf_paths:
+        for page_num in range(len(stage_generate.get_template_widgets(pdf_path))):
+            for sample_no in range(samples_per_page):
+                sample_seed = stage_generate.get_unit_seed(pdf_path.name, page_num, sample_no, global_seed)
+                random.seed(f'{sample_seed}|crop')
+                offsets = stage_crop.get_vertical_crop_offsets(stage_generate.PAGE_HEIGHT, crop_height)
+                for crop_no, (offset_y, _) in enumerate(offsets):
+                    records.append(VirtualRecord(str(pdf_path), page_num, sample_seed, offset_y,
+                                                 get_augment_seed(sample_seed, crop_no)))
+    return records
+
+
+class VirtualDataset:
+    """
+    Map-style dataset over a list of VirtualRecords: dataset[idx] renders and
+    returns (image, widgets) for records[idx], the image as a plain BGR ndarray
+    (picklable, so it can go through pipes and worker pools) and the
+    widgets as in the stage JSONs. The last 'cache_size' rendered pages are kept,
+    so the crops of one sample read in a row render it once; template documents
+    and page background rasters are cached by 0_generate_random_data.py itself.
+    """
+
+    def __init__(self, records: list[VirtualRecord], crop_height: int, augment: bool = True,
+                 cache_size: int = 4):
+        self.records = [VirtualRecord(*record) for record in records]
+        self.crop_height = crop_height
+        self.augment = augment
+        self.cache_size = cache_size
+        self._rendered = OrderedDict()
+
+        self.stage_generate = load_stage('0_generate_random_data.py')
+        self.stage_crop = load_stage('1_crop_images_vertically.py')
+        self.stage_augment = load_stage('2_augment_images.py')
+        self.stage_generate.SAVE_PDFS = False
+        if self.stage_generate.USE_FAKE_VALUE_BANK and not self.stage_generate.is_fake_value_bank_current(
+                self.stage_generate.FAKE_VALUE_BANK_PATH, self.stage_generate.FAKE_VALUES_PER_TYPE,
+                self.stage_generate.GLOBAL_SEED):
+            raise FileNotFoundError(f'{self.stage_generate.FAKE_VALUE_BANK_PATH} has not been built, '
+                                    f'or with other parameters')
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def render_page(self, record: VirtualRecord) -> tuple[np.ndarray, dict]:
+        key = (record.template, record.page_num, record.sample_seed)
+        if key in self._rendered:
+            self._rendered.move_to_end(key)
+            return self._rendered[key]
+
+        # the sample number only names the unit; the record's seed decides its content
+        unit = (Path(record.template), record.page_num, 0)
+        image, widgets, _ = self.stage_generate.render_sample(unit, seed=record.sample_seed)
+        image.setflags(write=False)
+        self._rendered[key] = (image, widgets)
+        if len(self._rendered) > self.cache_size:
+            self._rendered.popitem(last=False)
+        return image, widgets
+
+    def __getitem__(self, idx: int) -> tuple[np.ndarray, dict]:
+        image, widgets = self.render_item(self.records[idx])
+        # plain and contiguous, whatever the augmentations hand back
+        return np.ascontiguousarray(image), widgets
+
+    def render_item(self, record: VirtualRecord) -> tuple[np.ndarray, dict]:
+        page_image, page_widgets = self.render_page(record)
+
+        image = page_image[record.crop_offset:record.crop_offset + self.crop_height].copy()
+        widgets = self.stage_crop.adjust_widget_bboxes(page_widgets, record.crop_offset, self.crop_height)
+        if not self.augment:
+            return image, widgets
+
+        random.seed(record.augment_seed)
+        self.stage_augment.seed_augmentation(record.augment_seed)
+        try:
+            return self.stage_augment.augment_sample(image, widgets)
+        except Exception as e:
+            # the stage scripts drop such a sample; here it is served unaugmented
+            print(e)
+            return image, widgets
+
+    def save(self, path: Path) -> None:
+        with open(path, 'w') as f:
+            json.dump({'crop_height': self.crop_height, 'augment': self.augment,
+                       'records': [list(record) for record in self.records]}, f)
+
+    @classmethod
+    def load(cls, path: Path, **kwargs) -> 'VirtualDataset':
+        with open(path, 'r') as f:
+            data = json.load(f)
+        return cls(data['records'], data['crop_height'], data['augment'], **kwargs)
+
+
+# ------------------ Prefetch server ------------------
+# Protocol over a multiprocessing.connection Unix socket, one client at a time:
+#   ('len',)          -> number of samples
+#   ('get', idx)      -> (image, widgets)
+#   ('iter', indices) -> (idx, image, widgets) for each index in order, then None
+# An index out of range is answered with the IndexError instead (for 'iter' in
+# place of the sample and the None), which the client raises.
+# For 'iter' at most about 'prefetch' samples are rendered ahead of the client.
+# Runs of indices on the same page go to one worker, so it renders the page once.
+
+_served_dataset = None
+
+
+def _get_served_samples(indices: list[int]) -> list[tuple[np.ndarray, dict]]:
+    return [_served_dataset[idx] for idx in indices]
+
+
+def serve(dataset: VirtualDataset, address: str, num_workers: int, prefetch: int) -> None:
+    global _served_dataset
+    _served_dataset = dataset
+    # fork, so the workers inherit the dataset and the stage modules it was
+    # loaded with
+    pool = multiprocessing.get_context('fork').Pool(num_workers) if num_workers > 1 else None
+
+    Path(address).unlink(missing_ok=True)
+    with Listener(address, family='AF_UNIX') as listener:
+        print(f'serving {len(dataset)} samples on {address}')
+        while True:
+            with listener.accept() as conn:
+                try:
+                    while True:
+                        request = conn.recv()
+                        if request[0] == 'len':
+                            conn.send(len(dataset))
+                        elif request[0] == 'get':
+                            try:
+                                conn.send(dataset[request[1]])
+                            except IndexError as e:
+                                conn.send(e)
+                        elif request[0] == 'iter':
+                            try:
+                                _send_prefetched(conn, pool, request[1], prefetch)
+                            except IndexError as e:
+                                conn.send(e)
+                except EOFError:
+                    pass
+
+
+def _send_prefetched(conn, pool, indices, prefetch: int) -> None:
+    records = _served_dataset.records
+    runs = itertools.groupby(indices, key=lambda idx: records[idx][:3])
+    pending = deque()
+    in_flight = 0
+
+    def submit():
+        nonlocal in_flight
+        while in_flight < prefetch:
+            run = next(runs, None)
+            if run is None:
+                return
+            run_indices = list(run[1])
+            result = pool.apply_async(_get_served_samples, (run_indices,)) if pool else None
+            pending.append((run_indices, result))
+            in_flight += len(run_indices)
+
+    submit()
+    while pending:
+        run_indices, result = pending.popleft()
+        samples = result.get() if result else _get_served_samples(run_indices)
+        in_flight -= len(run_indices)
+        submit()
+        # send blocks while the client is not reading, so rendering stops once
+        # 'prefetch' samples are waiting
+        for idx, (image, widgets) in zip(run_indices, samples):
+            conn.send((idx, image, widgets))
+    conn.send(None)
+
+
+class VirtualDatasetClient:
+    """Reads samples from a server started with serve(); needs no PyMuPDF."""
+
+    def __init__(self, address: str):
+        self._conn = Client(address, family='AF_UNIX')
+
+    def _recv(self):
+        reply = self._conn.recv()
+        if isinstance(reply, IndexError):
+            raise reply
+        return reply
+
+    def __len__(self) -> int:
+        self._conn.send(('len',))
+        return self._recv()
+
+    def __getitem__(self, idx: int) -> tuple[np.ndarray, dict]:
+        self._conn.send(('get', idx))
+        return self._recv()
+
+    def iterate(self, indices):
+        """Yields (idx, image, widgets) for 'indices', prefetched by the server."""
+        self._conn.send(('iter', list(indices)))
+        while (item := self._recv()) is not None:
+            yield item
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+# ------------------ Configuration ------------------
+RECORDS_PATH = Path('out_virtual_dataset.json')
+CROP_HEIGHT = 1024
+AUGMENT = True
+
+# serve the dataset on this Unix socket after writing the records; None only
+# writes them
+SERVER_ADDRESS = 'out_virtual_dataset.sock'
+NUM_WORKERS = 4
+PREFETCH = 32
+
+if __name__ == '__main__':
+    stage_generate = load_stage('0_generate_random_data.py')
+    if stage_generate.USE_FAKE_VALUE_BANK:
+        stage_generate.ensure_fake_value_bank(stage_generate.FAKE_VALUE_BANK_PATH,
+                                              stage_generate.FAKE_VALUES_PER_TYPE,
+                                              stage_generate.GLOBAL_SEED)
+
+    records = build_records(stage_generate.pdf_paths, stage_generate.SAMPLES_PER_PAGE,
+                            stage_generate.GLOBAL_SEED, CROP_HEIGHT)
+    dataset = VirtualDataset(records, CROP_HEIGHT, AUGMENT)
+    dataset.save(RECORDS_PATH)
+    print(f'{len(dataset)} samples written to {RECORDS_PATH}')
+
+    if SERVER_ADDRESS is not None:
+        serve(dataset, SERVER_ADDRESS, NUM_WORKERS, PREFETCH)